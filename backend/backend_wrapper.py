@@ -6,13 +6,44 @@
 
 # PACKAGE IMPORTS
 import numpy as np
-from scipy.stats import norm
 import pandas as pd
 import json
+import os
+import threading
+from collections import OrderedDict
 
 # MODEL FUNCTION IMPORTS
-from backend.single_user_sampler import draw_posterior_theta
+from backend.single_user_sampler import (
+    draw_posterior_theta, draw_posterior_theta_from_state, init_posterior_state,
+    update_posterior_state, serialize_posterior_state, deserialize_posterior_state
+)
 from backend.hierarchical_sampler import run_hierarchical_model
+from backend.population_cache import POPULATION_CACHE, fit_population, fit_proportions
+from backend.subsampling import fit_subsampled_hierarchical_model, subsampling_enabled
+from backend.metrics import span
+from backend.reference_index import ReferenceIndex
+
+# TREATMENT ENCODING
+# Maps each reported location to its treatment arm; any of the N_TREATMENTS arms can be used.
+LOCATION_TREATMENT_MAPPING = {
+    'Home': 0,
+    'Work': 1,
+    'Other': 2
+}
+DEFAULT_TREATMENT = 0
+N_TREATMENTS = 6
+
+# OUTCOME NORMALIZATION
+# With TONEDOWN_GAUSSIANIZE_FEEDBACK=1 feedback scores are mapped to standard normal quantiles
+# of the population's feedback ECDF during extraction, so all users' outcomes share one scale.
+# The stored private posterior states are built from raw scores and are not used then, so
+# private users lose their constant-time path and are re-analyzed from their full history.
+GAUSSIANIZE_FEEDBACK = os.environ.get('TONEDOWN_GAUSSIANIZE_FEEDBACK', '0') == '1'
+
+# Encoded per-user data of recent pulls, keyed by the data version passed to backend_call
+_USER_INDEX_CACHE = OrderedDict()
+_USER_INDEX_CACHE_SIZE = 4
+_USER_INDEX_CACHE_LOCK = threading.Lock()
 
 # AUXILIARY FUNCTIONS
 def ecdf_transform(x, data):
@@ -27,14 +58,10 @@ def ecdf_transform(x, data):
     Returns:
       quantiles: numpy array of quantiles (in (0,1)) corresponding to x.
     """
-    sorted_data = np.sort(data)
-    n = len(sorted_data)
-    # For each x, count how many values in sorted_data are <= x, and divide by (n+1)
-    # Adding 1 to the denominator prevents getting exactly 0 or 1.
-    quantiles = np.searchsorted(sorted_data, x, side='right') / (n + 1)
-    return quantiles
+    # Quantiles are the counts of values <= x divided by (n+1), see ReferenceIndex.ecdf
+    return ReferenceIndex(data, max_size=None).ecdf(x)
 
-def compute_gaussian_outcome(y1, y2, global_data=None):
+def compute_gaussian_outcome(y1, y2, global_data=None, reference=None):
     """
     Compute a Gaussianized difference outcome from two outcome vectors.
     
@@ -45,30 +72,22 @@ def compute_gaussian_outcome(y1, y2, global_data=None):
     which should be approximately Gaussian.
     
     Parameters:
-      y1: numpy array of shape (N,) with 'before' values.
-      y2: numpy array of shape (N,) with 'after' values.
+      y1: numpy array of shape (N,) with 'before' values (or (users, N) for many users).
+      y2: numpy array of the same shape with 'after' values.
       global_data: (optional) numpy array to use as the reference for the ECDF.
                    If None, the combined y1 and y2 are used.
+      reference: (optional) prebuilt ReferenceIndex, reused across calls instead of
+                 sorting global_data again.
     
     Returns:
-      outcome: numpy array of shape (N,) representing the Gaussianized difference.
+      outcome: numpy array of the shape of y1 representing the Gaussianized difference.
     """
-    # Use the global reference if provided, otherwise combine y1 and y2.
-    if global_data is None:
-        combined = np.concatenate([y1, y2])
-    else:
-        combined = global_data
-
-    # Compute quantiles for y1 and y2 relative to the reference sample.
-    q_y1 = ecdf_transform(y1, combined)
-    q_y2 = ecdf_transform(y2, combined)
-    
-    # Map quantiles to standard normal quantiles.
-    g_y1 = norm.ppf(q_y1)
-    g_y2 = norm.ppf(q_y2)
-    
-    # Return the difference outcome.
-    return g_y2 - g_y1
+    if reference is None:
+        # Use the global reference if provided, otherwise combine y1 and y2.
+        if global_data is None:
+            global_data = np.concatenate([np.ravel(y1), np.ravel(y2)])
+        reference = ReferenceIndex(global_data, max_size=None)
+    return reference.gaussian_outcome(y1, y2)
 
 def is_user_private(user_data):
     """
@@ -91,9 +110,43 @@ def is_user_private(user_data):
     last_private = user_data_sorted['is_private'].dropna().iloc[-1]
     return bool(last_private == True)
 
-def extract_user_reg_data(user_data):
+def build_treatment_index(locations, treatment_mapping=None):
     """
-    Extract the outcome, covariates, and treatment indicators from the user data.
+    Map the reported locations to treatment arm indices.
+
+    Locations are converted to categorical codes and looked up in the mapping, so no Python
+    loop over observations is needed.
+
+    Parameters:
+      locations: numpy array of shape (N,) with the location of each observation.
+      treatment_mapping: dict mapping a location to its treatment arm (any of the
+                         N_TREATMENTS arms). Defaults to LOCATION_TREATMENT_MAPPING.
+
+    Returns:
+      arm: integer numpy array of shape (N,); unknown locations are mapped to DEFAULT_TREATMENT.
+    """
+    if treatment_mapping is None:
+        treatment_mapping = LOCATION_TREATMENT_MAPPING
+    codes = pd.Categorical(locations, categories=list(treatment_mapping)).codes
+    # Unknown locations get code -1, which picks the default arm appended last
+    arm_of_code = np.array(list(treatment_mapping.values()) + [DEFAULT_TREATMENT], dtype=np.int64)
+    return arm_of_code[codes]
+
+def build_treatment_matrix(locations, treatment_mapping=None, n_treatments=N_TREATMENTS):
+    """
+    Build the dense one-hot treatment indicator matrix from the reported locations.
+
+    The analysis path uses the arm indices of build_treatment_index; this is kept for callers
+    that need D explicitly.
+
+    Returns:
+      D: numpy array of shape (N, J); unknown locations are mapped to DEFAULT_TREATMENT.
+    """
+    return np.eye(n_treatments)[build_treatment_index(locations, treatment_mapping)]
+
+def extract_user_reg_data(user_data, treatment_mapping=None):
+    """
+    Extract the outcome, covariates, and treatment arm indices from the user data.
     Now incorporates feedback when available.
     """
     # Sort data by timestamp to ensure proper ordering
@@ -118,20 +171,206 @@ def extract_user_reg_data(user_data):
     covariate_cols = ['stress', 'sleep', 'noise']
     X = user_data[covariate_cols].values.astype(float)  # Convert numeric columns to float
 
-    # Create treatment indicators based on the location
-    D = np.zeros((len(user_data), 6))  # shape (N, 6)
-    location_mapping = {
-        'Home': 0,
-        'Work': 1,
-        'Other': 2
-    }
-    for i, location in enumerate(user_data['location']):
-        if location in location_mapping:
-            D[i, location_mapping[location]] = 1
-        else:
-            D[i, 0] = 1
+    # Treatment arm of each observation based on the location
+    arm = build_treatment_index(user_data['location'].values, treatment_mapping)
 
-    return Y, X, D
+    return Y, X, arm
+
+def extract_all_user_data(database_pull, treatment_mapping=None, data_version=None,
+                          feedback_reference=None):
+    """
+    Extract the privacy flag and the regression data of every user in a single pass.
+
+    The data is sorted once by (uid, timestamp) and every user's rows become one contiguous
+    block, so the privacy flag, the outcome choice (feedback if the user has any, otherwise
+    tinnitus-initial), the covariates and the treatments are computed with array operations
+    over the whole pull instead of a boolean scan and a re-sort per user. The result matches
+    is_user_private and extract_user_reg_data applied to each user separately.
+
+    Parameters:
+      database_pull (pd.DataFrame): Data of all users.
+      treatment_mapping (dict): Location to treatment arm mapping, see build_treatment_index.
+      data_version: Optional hashable identifying the content of database_pull (e.g. the
+                    storage revision). When given, the encoded data is cached and reused by
+                    later calls with the same version.
+      feedback_reference (ReferenceIndex): Feedback scores of the population, used when
+                    GAUSSIANIZE_FEEDBACK is set. Built from database_pull if not given.
+
+    Returns:
+      dict: Maps each uid to a tuple (is_private, (Y, X, arm)) with arm the treatment arm indices.
+    """
+    if data_version is not None:
+        mapping_key = tuple(sorted((treatment_mapping or LOCATION_TREATMENT_MAPPING).items()))
+        cache_key = (data_version, mapping_key)
+        with _USER_INDEX_CACHE_LOCK:
+            if cache_key in _USER_INDEX_CACHE:
+                _USER_INDEX_CACHE.move_to_end(cache_key)
+                return _USER_INDEX_CACHE[cache_key]
+        user_index = extract_all_user_data(database_pull, treatment_mapping,
+                                           feedback_reference=feedback_reference)
+        with _USER_INDEX_CACHE_LOCK:
+            _USER_INDEX_CACHE[cache_key] = user_index
+            while len(_USER_INDEX_CACHE) > _USER_INDEX_CACHE_SIZE:
+                _USER_INDEX_CACHE.popitem(last=False)
+        return user_index
+
+    if len(database_pull) == 0:
+        return {}
+
+    # One sort; every user's observations end up contiguous and in timestamp order
+    with span('sort'):
+        data = database_pull.sort_values(by=['uid', 'timestamp'], ascending=True, kind='stable')
+    with span('user_extraction'):
+        return _extract_sorted_user_data(data, treatment_mapping, feedback_reference)
+
+def _extract_sorted_user_data(data, treatment_mapping=None, feedback_reference=None):
+    """
+    Body of extract_all_user_data on data already sorted by (uid, timestamp).
+    """
+    uids = data['uid'].values
+    n_rows = len(data)
+
+    # Row ranges [starts, ends) of each user's block
+    starts = np.flatnonzero(np.r_[True, uids[1:] != uids[:-1]])
+    ends = np.r_[starts[1:], n_rows]
+    row_user = np.repeat(np.arange(len(starts)), ends - starts)
+
+    # Privacy flag: the last non-null is_private value of each user
+    if 'is_private' in data.columns:
+        private_values = data['is_private'].values
+        private_known = ~pd.isna(private_values)
+        last_known = np.maximum.reduceat(np.where(private_known, np.arange(n_rows), -1), starts)
+        is_private = [
+            bool(idx >= 0 and private_values[idx] == True) for idx in last_known
+        ]
+    else:
+        is_private = [False] * len(starts)
+
+    # Outcome: feedback rows for users with any feedback, otherwise all rows with tinnitus-initial
+    if 'feedback' in data.columns:
+        feedback = data['feedback'].to_numpy(dtype=float, na_value=np.nan)
+        has_feedback = ~np.isnan(feedback)
+    else:
+        feedback = np.full(n_rows, np.nan)
+        has_feedback = np.zeros(n_rows, dtype=bool)
+    if GAUSSIANIZE_FEEDBACK and has_feedback.any():
+        # One batched transform against the population's feedback scores
+        if feedback_reference is None:
+            feedback_reference = ReferenceIndex(feedback[has_feedback])
+        with span('gaussianize'):
+            feedback = feedback_reference.gaussianize(feedback)
+    user_has_feedback = np.add.reduceat(has_feedback.astype(int), starts) > 0
+    row_uses_feedback = user_has_feedback[row_user]
+    keep = has_feedback | ~row_uses_feedback
+
+    Y_all = np.where(
+        row_uses_feedback, feedback, data['tinnitus-initial'].to_numpy(dtype=float, na_value=np.nan)
+    )[keep]
+    covariate_cols = ['stress', 'sleep', 'noise']
+    X_all = data[covariate_cols].to_numpy(dtype=float, na_value=np.nan)[keep]
+    arm_all = build_treatment_index(data['location'].values[keep], treatment_mapping)
+
+    # Split the stacked arrays back into per-user blocks
+    counts = np.bincount(row_user[keep], minlength=len(starts))
+    offsets = np.r_[0, np.cumsum(counts)]
+    user_index = {}
+    for u, uid in enumerate(uids[starts]):
+        lo, hi = offsets[u], offsets[u + 1]
+        user_index[uid] = (is_private[u], (Y_all[lo:hi], X_all[lo:hi], arm_all[lo:hi]))
+    return user_index
+
+def update_user_posterior_state(user_state, new_rows, treatment_mapping=None):
+    """
+    Update a private-mode posterior state with newly uploaded rows.
+
+    The state mirrors extract_user_reg_data and is_user_private: it tracks the latest
+    privacy setting and the sufficient statistics of the regression data. Outcomes are
+    tinnitus-initial until the first feedback arrives; from then on only rows with feedback
+    are used, so the statistics are reset once when the user switches to feedback outcomes.
+
+    Parameters:
+      user_state (dict): State from a previous call, or None to start from the prior.
+      new_rows (pd.DataFrame): New rows of this user (or the full history for a new state).
+      treatment_mapping (dict): Location to treatment arm mapping, see build_treatment_index.
+
+    Returns:
+      dict: The updated user state with keys 'theta_state', 'uses_feedback', 'is_private'
+            and 'private_timestamp'.
+    """
+    covariate_cols = ['stress', 'sleep', 'noise']
+    if user_state is None:
+        user_state = {
+            'theta_state': init_posterior_state(N_TREATMENTS, len(covariate_cols)),
+            'uses_feedback': False,
+            'is_private': False,
+            'private_timestamp': None,
+        }
+    rows = new_rows.sort_values(by='timestamp', ascending=True)
+
+    # Latest privacy setting
+    if 'is_private' in rows.columns:
+        known = rows[~pd.isna(rows['is_private'])]
+        if len(known) > 0:
+            timestamp = str(known['timestamp'].iloc[-1])
+            if user_state['private_timestamp'] is None or timestamp >= user_state['private_timestamp']:
+                user_state['is_private'] = bool(known['is_private'].iloc[-1] == True)
+                user_state['private_timestamp'] = timestamp
+
+    # Outcome rows: switch to feedback outcomes on the first feedback
+    if 'feedback' in rows.columns:
+        feedback_mask = ~pd.isna(rows['feedback'])
+    else:
+        feedback_mask = pd.Series(False, index=rows.index)
+    if feedback_mask.any() and not user_state['uses_feedback']:
+        theta_state = user_state['theta_state']
+        user_state['theta_state'] = init_posterior_state(theta_state['J'], theta_state['K'])
+        user_state['uses_feedback'] = True
+    if user_state['uses_feedback']:
+        rows = rows[feedback_mask]
+        Y = rows['feedback'].values.astype(float)
+    else:
+        Y = rows['tinnitus-initial'].values.astype(float)
+
+    X = rows[covariate_cols].values.astype(float)
+    arm = build_treatment_index(rows['location'].values, treatment_mapping)
+    update_posterior_state(user_state['theta_state'], Y, X, arm)
+    return user_state
+
+def dump_user_posterior_state(user_state):
+    """
+    Serialize a user posterior state to a JSON string.
+    """
+    data = dict(user_state)
+    data['theta_state'] = serialize_posterior_state(user_state['theta_state'])
+    return json.dumps(data)
+
+def load_user_posterior_state(text):
+    """
+    Rebuild a user posterior state from the output of dump_user_posterior_state.
+    """
+    data = json.loads(text)
+    data['theta_state'] = deserialize_posterior_state(data['theta_state'])
+    return data
+
+def private_user_call(user_state, n_draws=1200):
+    """
+    Draw a private user's recommendation from their stored posterior state.
+
+    The cost does not depend on the length of the user's history.
+
+    Parameters:
+      user_state (dict): State from update_user_posterior_state.
+      n_draws (int): Number of posterior draws.
+
+    Returns:
+      tuple: (user_samples, user_posterior_best_json) as returned by backend_call.
+    """
+    with span('private_sampling'):
+        user_samples, user_posterior_best = draw_posterior_theta_from_state(
+            user_state['theta_state'], n_draws=n_draws
+        )
+    with span('format_json'):
+        return user_samples, format_posterior_best_json(user_posterior_best)
 
 def format_posterior_best_json(user_posterior_best):
     """
@@ -165,63 +404,131 @@ def format_posterior_best_json(user_posterior_best):
     return {name: prob for name, prob in prob_pairs}
 
 # MAIN ENTRY POINT
-def backend_call(user_id, database_pull):
-    # get user data
-    user_data = database_pull[database_pull['uid'] == user_id]
+def backend_call(user_id, database_pull, data_version=None, population_cache=POPULATION_CACHE,
+                 feedback_reference=None):
+    # index every user's privacy flag and regression data in one pass (cached per data version)
+    user_index = extract_all_user_data(database_pull, data_version=data_version,
+                                       feedback_reference=feedback_reference)
 
     # CHECK IF last observation of "is_private" is False
-    is_private = is_user_private(user_data)
+    if user_id in user_index:
+        is_private, user_reg_data = user_index[user_id]
+    else:
+        is_private, user_reg_data = False, extract_user_reg_data(database_pull.iloc[:0])
 
     # if user is private, filter their data and pass to single_user_sampler
     if is_private:
         # get user data
-        Y, X, D = extract_user_reg_data(user_data)
+        Y, X, arm = user_reg_data
         # run single_user_sampler
-        user_samples, user_posterior_best = draw_posterior_theta(Y, X, D, n_draws=1200)
+        with span('private_sampling'):
+            user_samples, user_posterior_best = draw_posterior_theta(Y, X, arm, n_draws=1200, J=N_TREATMENTS)
         # format as JSON
-        user_posterior_best_json = format_posterior_best_json(user_posterior_best)
+        with span('format_json'):
+            user_posterior_best_json = format_posterior_best_json(user_posterior_best)
     
+    # if user is in shared-data mode and the data version is known, serve the user's row of the cached population fit
+    elif data_version is not None and population_cache is not None and user_id in user_index:
+        fit = population_cache.get_user_fit(
+            user_id, data_version, lambda: fit_population(user_index, iter_sampling=1200, J=N_TREATMENTS)
+        )
+        m = fit['row_of'][user_id]
+        user_samples = fit['draws'].user_draws(m)  # memory-mapped or drawn on access
+        with span('format_json'):
+            user_posterior_best_json = format_posterior_best_json(fit_proportions(fit, [m])[0])
+
     # if user is in shared-data mode, pass his data "first" and append the rest, run hierarchical_sampler, and get draws and posterior_best_json for the user
     else:
-        group_data = []
-        for p in database_pull['uid'].unique():
-            other_user_data = database_pull[database_pull['uid'] == p]
-            if (p != user_id) and (not is_user_private(other_user_data)):
-                group_data.append(extract_user_reg_data(other_user_data))
-        group_data.append(extract_user_reg_data(user_data))
+        group_data = [
+            other_reg_data for p, (other_is_private, other_reg_data) in user_index.items()
+            if (p != user_id) and (not other_is_private)
+        ]
+        group_data.append(user_reg_data)
 
-        # run hierarchical_sampler
-        samples, posterior_best_json = run_hierarchical_model(group_data, iter_sampling=1200)
+        if subsampling_enabled(len(group_data)):
+            # fit the user together with at most MAX_USERS - 1 peers
+            fit = fit_subsampled_hierarchical_model(group_data, anchor=len(group_data) - 1,
+                                                    iter_sampling=1200, J=N_TREATMENTS)
+            user_samples = fit.user_draws(-1)
+            user_posterior_best = fit.user_proportions([-1])[0]
+        else:
+            # run hierarchical_sampler
+            samples, posterior_best_json = run_hierarchical_model(group_data, iter_sampling=1200, J=N_TREATMENTS)
 
-        # extract the user's samples
-        user_samples = samples[:, -1, :]
-        user_posterior_best = posterior_best_json[-1, :]
-        user_posterior_best_json = format_posterior_best_json(user_posterior_best)
+            # extract the user's samples
+            user_samples = samples[:, -1, :]
+            user_posterior_best = posterior_best_json[-1, :]
+        with span('format_json'):
+            user_posterior_best_json = format_posterior_best_json(user_posterior_best)
     
     return user_samples, user_posterior_best_json
 
+def backend_call_batch(user_ids, database_pull, data_version=None, population_cache=POPULATION_CACHE,
+                       feedback_reference=None, exact_revision=False, diagnostics=None):
+    """
+    Compute the intervention ranking of many users with a single hierarchical fit.
+
+    Private users are sampled individually with the single-user sampler; all requested shared
+    users are read from one population fit (the cached one when data_version is given).
+
+    Parameters:
+      user_ids (list or str): The users to rank, or "all" for every shared user.
+      database_pull (pd.DataFrame): Data of all users.
+      data_version: Optional version of database_pull, see backend_call.
+      population_cache (PopulationFitCache): Cache of population fits, or None.
+      feedback_reference (ReferenceIndex): Optional feedback reference, see extract_all_user_data.
+      exact_revision (bool): Only use a cached fit of data_version itself, not a slightly
+                             stale one, so the results belong to data_version.
+      diagnostics (dict): Optional dictionary that receives 'error', the sampling error if
+                          the shared users' fit fell back to uniform probabilities.
+
+    Returns:
+      dict: uid -> formatted posterior probabilities (as format_posterior_best_json). Users
+            without any data are left out.
+    """
+    user_index = extract_all_user_data(database_pull, data_version=data_version,
+                                       feedback_reference=feedback_reference)
+    if isinstance(user_ids, str) and user_ids == 'all':
+        user_ids = [uid for uid, (is_private, _) in user_index.items() if not is_private]
+
+    results = {}
+    shared_users = []
+    for uid in user_ids:
+        if uid not in user_index:
+            continue
+        is_private, (Y, X, arm) = user_index[uid]
+        if is_private:
+            with span('private_sampling'):
+                _, user_posterior_best = draw_posterior_theta(Y, X, arm, n_draws=1200, J=N_TREATMENTS)
+            results[uid] = format_posterior_best_json(user_posterior_best)
+        else:
+            shared_users.append(uid)
+
+    if shared_users:
+        def fit_fn():
+            return fit_population(user_index, iter_sampling=1200, J=N_TREATMENTS)
+
+        fit = None
+        if data_version is not None and population_cache is not None:
+            fit = population_cache.get_user_fit(shared_users[0], data_version, fit_fn,
+                                                exact=exact_revision)
+        if fit is None or any(uid not in fit['row_of'] for uid in shared_users):
+            # a single fit over all shared users serves every requested one
+            fit = fit_fn()
+        if diagnostics is not None and fit.get('error') is not None:
+            diagnostics['error'] = fit['error']
+        proportions = fit_proportions(fit, [fit['row_of'][uid] for uid in shared_users])
+        with span('format_json'):
+            for uid, user_proportions in zip(shared_users, proportions):
+                results[uid] = format_posterior_best_json(user_proportions)
+
+    return results
+
 if __name__ == "__main__":
-    # Create example data
-    np.random.seed(42)  # For reproducibility
-    
-    # Create sample database with required columns
-    n_users = 3
-    n_observations = 10
-    
-    example_data = {
-        'uid': np.repeat(['user1', 'user2', 'user3'], n_observations),
-        'timestamp': np.tile(pd.date_range(start='2024-01-01', periods=n_observations), n_users),
-        'is_private': np.repeat([False, True, False], n_observations),
-        'y1': np.random.normal(0, 1, n_users * n_observations),
-        'y2': np.random.normal(0.5, 1, n_users * n_observations),
-        'x1': np.random.normal(0, 1, n_users * n_observations),
-        'x2': np.random.normal(0, 1, n_users * n_observations),
-        'd1': np.random.binomial(1, 0.5, n_users * n_observations),
-        'd2': np.random.binomial(1, 0.5, n_users * n_observations)
-    }
-    
-    # Convert to DataFrame
-    example_df = pd.DataFrame(example_data)
+    from backend.benchmark import generate_synthetic_population
+
+    # Create example data with the schema uploaded by the app
+    example_df = generate_synthetic_population(n_users=3, n_observations=10, private_fraction=0.3, seed=42)
     
     # Test the backend_call function with a non-private user
     test_user_id = 'user1'
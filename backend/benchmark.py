@@ -0,0 +1,338 @@
+## BENCHMARK SUITE FOR THE ANALYSIS PATH
+## Generates synthetic populations with the schema uploaded by the ToneDown app and measures
+## wall time, peak Python memory and a per-stage breakdown of the private (single-user) and the
+## shared (hierarchical) path. Results are written as JSON lines, one record per run.
+##
+## Usage:
+##   python -m backend.benchmark --users 10 50 --observations 10 40 --private-fractions 0 0.5 \
+##       --method gibbs --output bench_results.jsonl
+##   python -m backend.benchmark --users 2000 --observations 20 --subsample-budgets 100 400 \
+##       --method gibbs --output bench_results.jsonl
+
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from backend.backend_wrapper import (
+    extract_all_user_data, format_posterior_best_json, LOCATION_TREATMENT_MAPPING, N_TREATMENTS
+)
+from backend.hierarchical_sampler import (
+    prepare_hierarchical_data, run_hierarchical_model, sample_theta, INFERENCE_BACKEND
+)
+from backend.posterior_summaries import probability_of_best
+from backend.single_user_sampler import (
+    draw_posterior_theta, compare_best_estimators, posterior_theta, init_posterior_state,
+    update_posterior_state
+)
+from backend.subsampling import fit_subsampled_hierarchical_model, SUBSAMPLE_STRATEGIES
+
+# SYNTHETIC DATA
+def generate_synthetic_population(n_users, n_observations, private_fraction=0.0,
+                                  feedback_fraction=0.5, seed=0):
+    """
+    Generate a synthetic database pull with the real upload schema.
+
+    Every user has n_observations check-ins. Covariates are integer scores as reported in the
+    app, the location picks the treatment, and a fraction of the rows carries feedback whose
+    value depends on a user-specific treatment effect plus the covariates.
+
+    Parameters:
+      n_users (int): Number of users.
+      n_observations (int): Observations per user.
+      private_fraction (float): Fraction of users in private mode.
+      feedback_fraction (float): Fraction of rows with feedback.
+      seed (int): Random seed.
+
+    Returns:
+      pd.DataFrame: Columns uid, timestamp, is_private, feedback, tinnitus-initial, stress,
+                    sleep, noise, intoxication and location.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = n_users * n_observations
+    locations = np.array(list(LOCATION_TREATMENT_MAPPING))
+
+    uid = np.repeat([f"user{u}" for u in range(n_users)], n_observations)
+    user_of_row = np.repeat(np.arange(n_users), n_observations)
+    is_private_user = rng.random(n_users) < private_fraction
+
+    stress = rng.integers(0, 11, n_rows)
+    sleep = rng.integers(0, 11, n_rows)
+    noise = rng.integers(0, 11, n_rows)
+    location_code = rng.integers(0, len(locations), n_rows)
+
+    # Outcome model: user-specific effect of the location's treatment plus covariate effects
+    effects = rng.normal(0, 1, (n_users, len(locations)))
+    signal = (effects[user_of_row, location_code]
+              - 0.2 * (stress - 5) + 0.1 * (sleep - 5) - 0.1 * (noise - 5))
+    feedback = np.clip(np.round(5 + 2 * signal + rng.normal(0, 1, n_rows)), 0, 10)
+    feedback[rng.random(n_rows) >= feedback_fraction] = np.nan
+
+    start = pd.Timestamp('2024-01-01')
+    offsets = pd.to_timedelta(rng.integers(0, 90 * 24 * 60, n_rows), unit='m')
+    timestamps = (start + offsets).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    return pd.DataFrame({
+        'uid': uid,
+        'timestamp': timestamps,
+        'is_private': is_private_user[user_of_row],
+        'feedback': feedback,
+        'tinnitus-initial': rng.integers(0, 11, n_rows),
+        'stress': stress,
+        'sleep': sleep,
+        'noise': noise,
+        'intoxication': rng.choice(['no', 'yes'], n_rows, p=[0.9, 0.1]),
+        'location': locations[location_code],
+    })
+
+# MEASUREMENT
+class StageTimer:
+    """
+    Collect wall time per named stage.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+        return result
+
+def _measure(fn):
+    """
+    Run fn and return (result, wall seconds, peak traced Python memory in bytes).
+
+    CmdStan runs in a subprocess, so its memory is not included.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+    finally:
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def benchmark_private_path(database_pull, user_id, n_draws=1200):
+    """
+    Time the private-user path stage by stage.
+    """
+    timer = StageTimer()
+    user_index = timer.time('extract', extract_all_user_data, database_pull)
+    _, (Y, X, arm) = user_index[user_id]
+    _, posterior_best = timer.time('sample', draw_posterior_theta, Y, X, arm, n_draws=n_draws,
+                                   J=N_TREATMENTS)
+    timer.time('format', format_posterior_best_json, posterior_best)
+    return timer.stages
+
+def benchmark_shared_path(database_pull, user_id, method, iter_sampling, iter_warmup, chains):
+    """
+    Time the hierarchical path stage by stage.
+    """
+    timer = StageTimer()
+    user_index = timer.time('extract', extract_all_user_data, database_pull)
+    group_data = [reg_data for uid, (is_private, reg_data) in user_index.items()
+                  if uid != user_id and not is_private]
+    group_data.append(user_index[user_id][1])
+    data = timer.time('prepare', prepare_hierarchical_data, group_data, J=N_TREATMENTS)
+    theta_draws = timer.time('sample', sample_theta, data, method, iter_sampling=iter_sampling,
+                             iter_warmup=iter_warmup, chains=chains)
+
+    posterior_best = timer.time('reduce', probability_of_best, theta_draws[:, -1, :])
+    timer.time('format', format_posterior_best_json, posterior_best)
+    return timer.stages
+
+# MAIN ENTRY POINT
+def run_benchmark(users=(10, 50), observations=(10, 40), private_fractions=(0.0, 0.5),
+                  method=INFERENCE_BACKEND, iter_sampling=300, iter_warmup=200, chains=4,
+                  repeats=1, seed=0, output=None):
+    """
+    Sweep users x observations x private fraction and benchmark both analysis paths.
+
+    Parameters:
+      users, observations, private_fractions (iterables): The sweep grid.
+      method (str): Inference backend of the hierarchical path.
+      iter_sampling, iter_warmup, chains (int): Sampler settings of the hierarchical path.
+      repeats (int): Repetitions per configuration.
+      seed (int): Random seed of the data generator.
+      output (str): Optional path of a JSON lines file the records are appended to.
+
+    Returns:
+      list: One record per run with the configuration, wall time, peak memory and stages.
+    """
+    records = []
+    environment = {'python': platform.python_version(), 'numpy': np.__version__,
+                   'pandas': pd.__version__}
+    for n_users in users:
+        for n_obs in observations:
+            for private_fraction in private_fractions:
+                database_pull = generate_synthetic_population(
+                    n_users, n_obs, private_fraction=private_fraction, seed=seed
+                )
+                user_index = extract_all_user_data(database_pull)
+                private_users = [uid for uid, (p, _) in user_index.items() if p]
+                shared_users = [uid for uid, (p, _) in user_index.items() if not p]
+
+                runs = []
+                if private_users:
+                    runs.append(('private', private_users[0], lambda uid: benchmark_private_path(
+                        database_pull, uid)))
+                if shared_users:
+                    runs.append(('shared', shared_users[0], lambda uid: benchmark_shared_path(
+                        database_pull, uid, method, iter_sampling, iter_warmup, chains)))
+
+                for path, user_id, fn in runs:
+                    for repeat in range(repeats):
+                        stages, seconds, peak = _measure(lambda: fn(user_id))
+                        record = {
+                            'timestamp': time.time(),
+                            'path': path,
+                            'n_users': n_users,
+                            'n_observations': n_obs,
+                            'private_fraction': private_fraction,
+                            'method': method,
+                            'iter_sampling': iter_sampling,
+                            'iter_warmup': iter_warmup,
+                            'chains': chains,
+                            'repeat': repeat,
+                            'seconds': seconds,
+                            'peak_memory_bytes': peak,
+                            'stages': stages,
+                            'environment': environment,
+                        }
+                        records.append(record)
+                        print(json.dumps(record))
+    if output is not None:
+        with open(output, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+    return records
+
+def run_estimator_benchmark(n_users=20, n_observations=20, n_draws=1200, seed=0, output=None):
+    """
+    Compare the probability-of-best estimators of the single-user sampler on synthetic users
+    against a large Monte Carlo reference.
+
+    Returns:
+      list: One record per user and estimator with seconds and max absolute error.
+    """
+    database_pull = generate_synthetic_population(n_users, n_observations, seed=seed)
+    records = []
+    for uid, (_, (Y, X, arm)) in extract_all_user_data(database_pull).items():
+        state = update_posterior_state(init_posterior_state(N_TREATMENTS, X.shape[1]), Y, X, arm)
+        mu, Sigma = posterior_theta(state)
+        for estimator, result in compare_best_estimators(mu, Sigma, n_draws=n_draws, seed=seed).items():
+            record = {'path': 'estimator', 'uid': uid, 'estimator': estimator, 'n_draws': n_draws}
+            record.update(result)
+            records.append(record)
+            print(json.dumps(record))
+    if output is not None:
+        with open(output, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+    return records
+
+def compare_subsampling(n_users=1000, n_observations=20, budgets=(100, 250), strategies=SUBSAMPLE_STRATEGIES,
+                        method=INFERENCE_BACKEND, iter_sampling=300, iter_warmup=200, chains=4,
+                        seed=0, output=None):
+    """
+    Compare subsampled hierarchical fits against the full fit of a synthetic population.
+
+    The 'stratified' strategy is compared on all users. The 'similarity' strategy fits the
+    neighbours of a single user, so it is compared on that user (the last one), as served
+    by backend_call.
+
+    Parameters:
+      n_users, n_observations (int): Size of the synthetic population (all shared).
+      budgets (iterable): Values of max_users to compare.
+      strategies (iterable): Peer selection strategies, see subsampling.select_peers.
+      method, iter_sampling, iter_warmup, chains: Sampler settings of all fits.
+      seed (int): Random seed of the data generator and the subsampling.
+      output (str): Optional path of a JSON lines file the records are appended to.
+
+    Returns:
+      list: One record for the full fit and one per budget and strategy, with seconds and
+            the max and mean absolute difference of the best-arm probabilities to the full
+            fit and the fraction of users with the same most probable arm.
+    """
+    database_pull = generate_synthetic_population(n_users, n_observations, seed=seed)
+    group_data = [reg_data for _, reg_data in extract_all_user_data(database_pull).values()]
+    sampler = {'method': method, 'iter_sampling': iter_sampling, 'iter_warmup': iter_warmup,
+               'chains': chains, 'J': N_TREATMENTS}
+    config = {'path': 'subsampling', 'n_users': len(group_data), 'n_observations': n_observations,
+              'method': method, 'iter_sampling': iter_sampling, 'iter_warmup': iter_warmup,
+              'chains': chains}
+
+    start = time.perf_counter()
+    _, full = run_hierarchical_model(group_data, **sampler)
+    records = [dict(config, max_users=len(group_data), strategy='full',
+                    seconds=time.perf_counter() - start)]
+
+    for max_users in budgets:
+        for strategy in strategies:
+            start = time.perf_counter()
+            fit = fit_subsampled_hierarchical_model(group_data, max_users=max_users,
+                                                    strategy=strategy, anchor=len(group_data) - 1,
+                                                    seed=seed, **sampler)
+            if strategy == 'similarity':
+                proportions = fit.user_proportions([-1])
+                reference = full[-1:]
+            else:
+                proportions = fit.user_proportions(np.arange(len(group_data)))
+                reference = full
+            seconds = time.perf_counter() - start
+            difference = np.abs(proportions - reference)
+            records.append(dict(
+                config, max_users=max_users, strategy=strategy, seconds=seconds,
+                compared_users=len(reference),
+                max_abs_difference=float(difference.max()),
+                mean_abs_difference=float(difference.mean()),
+                top_arm_agreement=float(np.mean(
+                    np.argmax(proportions, axis=1) == np.argmax(reference, axis=1)
+                )),
+            ))
+    for record in records:
+        print(json.dumps(record))
+    if output is not None:
+        with open(output, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+    return records
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ToneDown analysis path.')
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--observations', type=int, nargs='+', default=[10, 40])
+    parser.add_argument('--private-fractions', type=float, nargs='+', default=[0.0, 0.5])
+    parser.add_argument('--method', default=INFERENCE_BACKEND)
+    parser.add_argument('--iter-sampling', type=int, default=300)
+    parser.add_argument('--iter-warmup', type=int, default=200)
+    parser.add_argument('--chains', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--estimators', action='store_true',
+                        help='also compare the probability-of-best estimators')
+    parser.add_argument('--subsample-budgets', type=int, nargs='+', default=None,
+                        help='compare subsampled fits with these user budgets against the full '
+                             'fit of a population of the largest --users value')
+    parser.add_argument('--output', default=None, help='JSON lines file to append results to')
+    args = parser.parse_args()
+
+    run_benchmark(users=args.users, observations=args.observations,
+                  private_fractions=args.private_fractions, method=args.method,
+                  iter_sampling=args.iter_sampling, iter_warmup=args.iter_warmup,
+                  chains=args.chains, repeats=args.repeats, seed=args.seed, output=args.output)
+    if args.estimators:
+        run_estimator_benchmark(seed=args.seed, output=args.output)
+    if args.subsample_budgets:
+        compare_subsampling(n_users=max(args.users), n_observations=max(args.observations),
+                            budgets=args.subsample_budgets, method=args.method,
+                            iter_sampling=args.iter_sampling, iter_warmup=args.iter_warmup,
+                            chains=args.chains, seed=args.seed, output=args.output)
@@ -0,0 +1,168 @@
+## CPU BUDGET FOR SAMPLER RUNS
+## Every sampler run reserves cores from a process-wide budget before it starts. A run gets
+## as many cores as it can use (one per chain, plus within-chain threads for reduce_sum on
+## large datasets) as long as they are free, fewer when the host is busy, and waits in the
+## queue while not even its minimum is available. The granted cores are turned into
+## cmdstanpy's parallel_chains and threads_per_chain.
+## The budget is host-wide: every core is a slot lock file in TONEDOWN_CPU_BUDGET_DIR, and a run
+## holds an advisory lock (flock) on each of its slots, so the gunicorn workers, their job pool
+## workers and background refits all draw from the same cores. Without fcntl, or with an empty
+## TONEDOWN_CPU_BUDGET_DIR, the budget only covers the threads of one process.
+
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Cores shared by all sampler runs of this process
+CPU_BUDGET_CORES = int(os.environ.get('TONEDOWN_CPU_BUDGET', str(os.cpu_count() or 1)))
+# Upper bound on reduce_sum threads within one chain
+MAX_THREADS_PER_CHAIN = int(os.environ.get('TONEDOWN_MAX_THREADS_PER_CHAIN', '4'))
+# Observations per within-chain thread; smaller datasets do not gain from splitting the likelihood
+ROWS_PER_THREAD = 1000
+# Directory of the slot lock files shared by all processes of the host
+CPU_BUDGET_DIR = os.environ.get('TONEDOWN_CPU_BUDGET_DIR',
+                                os.path.join(tempfile.gettempdir(), 'tonedown-cpu-budget'))
+# Seconds between checks for cores released by other processes while a run is queued
+SLOT_POLL_SECONDS = 0.1
+
+class CpuBudget:
+    """
+    Counting budget of cores shared by concurrent sampler runs of all processes that use the
+    same lock directory.
+
+    Parameters:
+      cores (int): Cores of the budget.
+      lock_dir (str): Directory of the slot lock files; None limits the budget to this process.
+    """
+
+    def __init__(self, cores=CPU_BUDGET_CORES, lock_dir=CPU_BUDGET_DIR):
+        self.cores = max(1, int(cores))
+        self.lock_dir = lock_dir if lock_dir and fcntl is not None else None
+        self.in_use = 0
+        self.queued = 0
+        self._cond = threading.Condition()
+
+    def resize(self, cores):
+        """
+        Change the number of cores of the budget.
+        """
+        with self._cond:
+            self.cores = max(1, int(cores))
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, wanted, minimum=1, step=1, timeout=None):
+        """
+        Reserve cores for the enclosed block.
+
+        Parameters:
+          wanted (int): Cores the run can use.
+          minimum (int): Cores the run needs to start; it waits until they are free.
+          step (int): Grant a multiple of step cores above the minimum, e.g. the number of
+                      chains, so no reserved core sits idle.
+          timeout (float): Longest wait in seconds (None waits indefinitely).
+
+        Yields:
+          int: The granted number of cores, between minimum and wanted (both capped by the budget).
+
+        Raises:
+          TimeoutError: If the minimum did not become free within the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            wanted = min(max(1, int(wanted)), self.cores)
+            minimum = min(max(1, int(minimum)), wanted)
+            self.queued += 1
+            try:
+                while True:
+                    slots = self._acquire_slots(wanted, minimum, max(1, int(step)))
+                    if slots is not None:
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"No {minimum} free cores within {timeout} seconds")
+                    # Woken by a release in this process; cores freed by other processes are polled
+                    wait = SLOT_POLL_SECONDS if self.lock_dir else remaining
+                    self._cond.wait(wait if remaining is None else min(wait, remaining))
+            finally:
+                self.queued -= 1
+            self.in_use += len(slots)
+        try:
+            yield len(slots)
+        finally:
+            with self._cond:
+                self._release_slots(slots)
+                self.in_use -= len(slots)
+                self._cond.notify_all()
+
+    def usage(self):
+        """
+        Return the current budget, cores in use and number of queued runs of this process.
+        """
+        with self._cond:
+            return {'cores': self.cores, 'in_use': self.in_use, 'queued': self.queued}
+
+    def _acquire_slots(self, wanted, minimum, step):
+        # Take between minimum and wanted free slots, or None if fewer than minimum are free
+        # (condition held)
+        if self.lock_dir is None:
+            free = self.cores - self.in_use
+            if free < minimum:
+                return None
+            granted = max(minimum, min(wanted, free) - min(wanted, free) % step)
+            return [None] * granted
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        slots = []
+        for i in range(self.cores):
+            if len(slots) == wanted:
+                break
+            fd = os.open(os.path.join(self.lock_dir, f'core-{i}.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            slots.append(fd)
+        if len(slots) < minimum:
+            self._release_slots(slots)
+            return None
+        granted = max(minimum, len(slots) - len(slots) % step)
+        self._release_slots(slots[granted:])
+        return slots[:granted]
+
+    def _release_slots(self, slots):
+        for fd in slots:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+CPU_BUDGET = CpuBudget()
+
+def wanted_threads_per_chain(n_observations):
+    """
+    Number of reduce_sum threads a chain can use on a dataset of the given size.
+    """
+    return max(1, min(MAX_THREADS_PER_CHAIN, n_observations // ROWS_PER_THREAD))
+
+def chain_layout(cores, chains):
+    """
+    Split granted cores into cmdstanpy's parallel_chains and threads_per_chain.
+
+    Parameters:
+      cores (int): Granted cores.
+      chains (int): Number of chains of the run.
+
+    Returns:
+      tuple: (parallel_chains, threads_per_chain).
+    """
+    parallel_chains = max(1, min(chains, cores))
+    threads_per_chain = max(1, cores // chains)
+    return parallel_chains, threads_per_chain
@@ -0,0 +1,117 @@
+## ON-DISK STORE OF POPULATION THETA DRAWS
+## A population fit produces (n_draws, M, J) draws, hundreds of MB for large M, while a request
+## only needs the draws of one user. Fits therefore write their draws once to a .npy file keyed
+## by a fit id, laid out as (M, n_draws, J) so each user's draws are contiguous, and read them
+## back through a memory map: a worker only pages in the users it actually serves. The map is
+## opened as soon as a fit is stored, so eviction of the file by another process does not break
+## fits that are still cached.
+
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+DRAW_STORE_DIR = Path(os.environ.get('TONEDOWN_DRAW_DIR', Path(__file__).parent / '.draw_store'))
+# Stored precision; float32 halves the file size and page-ins
+DRAW_DTYPE = os.environ.get('TONEDOWN_DRAW_DTYPE', 'float64')
+# Number of stored fits kept on disk (oldest are deleted)
+DRAW_STORE_SIZE = int(os.environ.get('TONEDOWN_DRAW_STORE_SIZE', '8'))
+# Users transposed per write, so saving needs little memory beyond the draws themselves
+_USERS_PER_WRITE = 256
+
+class StoredDraws:
+    """
+    Memory-mapped theta draws of one fit.
+
+    The file is mapped when the accessor is created, right after the fit is written. The open
+    map keeps the data readable for as long as the fit is cached, even after another process
+    evicted the file from the store (POSIX keeps unlinked files alive while they are mapped).
+
+    Attributes:
+      fit_id (str): Id of the fit.
+      path (Path): The .npy file, with shape (M, n_draws, J).
+    """
+
+    def __init__(self, fit_id, path):
+        self.fit_id = fit_id
+        self.path = Path(path)
+        self._array = np.load(self.path, mmap_mode='r')
+
+    @property
+    def array(self):
+        """
+        The (M, n_draws, J) memory map; pages are read from disk on access.
+        """
+        return self._array
+
+    @property
+    def shape(self):
+        # Shape in the sampler's (n_draws, M, J) order
+        M, n_draws, J = self.array.shape
+        return n_draws, M, J
+
+    def user_draws(self, m):
+        """
+        Return the (n_draws, J) draws of the user in row m, read from disk on access.
+        """
+        return self.array[m]
+
+def save_draws(theta_draws, fit_id=None, dtype=DRAW_DTYPE, directory=None):
+    """
+    Write the draws of a fit to the store.
+
+    Parameters:
+      theta_draws (np.ndarray): (n_draws, M, J) draws.
+      fit_id (str): Id of the fit; a new random id by default.
+      dtype (str): Stored precision, 'float64' or 'float32'.
+      directory (Path): Store directory, DRAW_STORE_DIR by default.
+
+    Returns:
+      StoredDraws: Lazy accessor of the stored draws.
+    """
+    directory = Path(directory or DRAW_STORE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    fit_id = fit_id or uuid.uuid4().hex
+    path = directory / f"{fit_id}.npy"
+    n_draws, M, J = theta_draws.shape
+
+    # Write under a temporary name so readers never see a partial file
+    tmp_path = directory / f"{fit_id}.{os.getpid()}.tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(M, n_draws, J))
+    for start in range(0, M, _USERS_PER_WRITE):
+        stop = min(start + _USERS_PER_WRITE, M)
+        out[start:stop] = np.swapaxes(theta_draws[:, start:stop, :], 0, 1)
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+    _evict(directory)
+    return StoredDraws(fit_id, path)
+
+def open_draws(fit_id, directory=None):
+    """
+    Return the stored draws of a fit, e.g. one written by another worker process.
+
+    Raises:
+      FileNotFoundError: If the fit is not in the store.
+    """
+    path = Path(directory or DRAW_STORE_DIR) / f"{fit_id}.npy"
+    if not path.exists():
+        raise FileNotFoundError(f"No stored draws for fit {fit_id}")
+    return StoredDraws(fit_id, path)
+
+def _evict(directory):
+    # Delete the oldest fits beyond DRAW_STORE_SIZE. Open memory maps stay valid on POSIX;
+    # a deleted file is only released when its last map is closed.
+    mtimes = {}
+    for f in directory.glob('*.npy'):
+        try:
+            mtimes[f] = f.stat().st_mtime
+        except FileNotFoundError:  # evicted by another process meanwhile
+            pass
+    for old in sorted(mtimes, key=mtimes.get, reverse=True)[DRAW_STORE_SIZE:]:
+        try:
+            old.unlink(missing_ok=True)
+        except OSError as e:
+            print(f"Error deleting stored draws {old}: {str(e)}")
@@ -0,0 +1,59 @@
+## CROSS-PROCESS FILE LOCKS
+## Serialize work between the worker processes of a multi-worker server on one host, e.g.
+## compiling the Stan model or initializing the store, with an advisory lock (flock) on a
+## lock file. On platforms without fcntl the lock only covers the threads of one process.
+
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+_THREAD_LOCKS = {}
+_THREAD_LOCKS_LOCK = threading.Lock()
+
+def _thread_lock(path):
+    with _THREAD_LOCKS_LOCK:
+        lock = _THREAD_LOCKS.get(path)
+        if lock is None:
+            lock = threading.Lock()
+            _THREAD_LOCKS[path] = lock
+        return lock
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Hold an exclusive lock on a lock file for the enclosed block.
+
+    Parameters:
+      path (str): Path of the lock file (created if missing).
+      blocking (bool): Wait for the lock; otherwise give up at once if it is held.
+
+    Yields:
+      bool: True if the lock is held, False if blocking is False and it was taken.
+    """
+    path = os.path.abspath(str(path))
+    thread_lock = _thread_lock(path)
+    if not thread_lock.acquire(blocking):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        thread_lock.release()
@@ -0,0 +1,121 @@
+## BLOCKED GIBBS SAMPLER for the hierarchical Gaussian regression in hier_reg.stan
+## A pure-NumPy alternative to NUTS. With known noise sigma every full conditional is available
+## in closed form:
+##   - each user's coefficients [theta_m; beta_m] are Gaussian (one batched Cholesky per sweep),
+##   - the population means mu_theta, mu_beta are Gaussian,
+##   - the population scales use the inverse-gamma mixture representation of the half-Cauchy
+##     prior (Makalic & Schmidt, 2016): sigma^2 | a ~ IG(1/2, 1/a), a ~ IG(1/2, 1/A^2).
+
+import numpy as np
+
+from backend.single_user_sampler import segment_sum
+
+# Hyperprior parameters, matching hier_reg.stan
+MU_PRIOR_SD = 4.0       # mu_theta, mu_beta ~ normal(0, 4)
+SCALE_PRIOR_SCALE = 4.0  # sigma_theta, sigma_beta ~ cauchy(0, 4), truncated to positive values
+
+# AUXILIARY FUNCTION
+def user_sufficient_statistics(data):
+    """
+    Compute each user's Z'Z and Z'Y with Z = [D, X] from the Stan data dictionary.
+
+    The treatment blocks are built from segment sums over (user, arm) pairs, so the one-hot
+    matrix D is never formed.
+
+    Parameters:
+      data (dict): Output of prepare_hierarchical_data.
+
+    Returns:
+      tuple: (ZtZ, ZtY, n) with shapes (M, J+K, J+K), (M, J+K) and (M,).
+    """
+    M, J, K = data['M'], data['J'], data['K']
+    user = np.asarray(data['user']) - 1
+    cell = user * J + (np.asarray(data['arm']) - 1)  # (user, arm) pair of each observation
+    X = np.asarray(data['X'], dtype=float).reshape(-1, K)
+    Y = np.asarray(data['Y'], dtype=float)
+    P = J + K
+
+    ZtZ = np.zeros((M, P, P))
+    ZtY = np.zeros((M, P))
+    arm_counts = np.bincount(cell, minlength=M * J).reshape(M, J)
+    X_by_arm = segment_sum(cell, X, M * J).reshape(M, J, K)
+    XtX = segment_sum(user, (X[:, :, None] * X[:, None, :]).reshape(-1, K * K), M)
+    ZtZ[:, np.arange(J), np.arange(J)] = arm_counts
+    ZtZ[:, :J, J:] = X_by_arm
+    ZtZ[:, J:, :J] = np.swapaxes(X_by_arm, 1, 2)
+    ZtZ[:, J:, J:] = XtX.reshape(M, K, K)
+    ZtY[:, :J] = segment_sum(cell, Y, M * J).reshape(M, J)
+    ZtY[:, J:] = segment_sum(user, X * Y[:, None], M)
+    n = np.bincount(user, minlength=M)
+    return ZtZ, ZtY, n
+
+def _inverse_gamma(rng, shape, scale):
+    # Draw from IG(shape, scale) elementwise
+    return scale / rng.gamma(shape, 1.0, size=np.shape(scale))
+
+# MAIN FUNCTION
+def gibbs_sample_hierarchical(data, iter_sampling=1000, iter_warmup=500, chains=4, seed=None,
+                              hyper_draws=None):
+    """
+    Draw from the posterior of the hierarchical model with a blocked Gibbs sampler.
+
+    Parameters:
+      data (dict): Output of prepare_hierarchical_data.
+      iter_sampling (int): Number of kept draws per chain.
+      iter_warmup (int): Number of discarded burn-in sweeps per chain.
+      chains (int): Number of independent chains.
+      seed (int): Random seed.
+      hyper_draws (dict): Optional dictionary that is filled with the matching draws of the
+                          population means 'mu' and variances 's2', each (chains*iter_sampling, J+K).
+
+    Returns:
+      theta_draws : (chains*iter_sampling, M, J) numpy array of treatment effect draws,
+                    with chains stacked in order like cmdstanpy's stan_variable.
+    """
+    rng = np.random.default_rng(seed)
+    M, J = data['M'], data['J']
+    sigma2 = float(data['sigma']) ** 2
+    ZtZ, ZtY, _ = user_sufficient_statistics(data)
+    P = ZtZ.shape[1]
+    data_precision = ZtZ / sigma2
+    data_shift = ZtY / sigma2
+    diag = np.arange(P)
+
+    theta_draws = np.empty((chains, iter_sampling, M, J))
+    mu_draws = np.empty((chains, iter_sampling, P))
+    s2_draws = np.empty((chains, iter_sampling, P))
+    for chain in range(chains):
+        # Dispersed initial values
+        mu = rng.normal(0, 1, P)
+        s2 = np.exp(rng.uniform(-1, 1, P))
+        a = np.ones(P)
+
+        for it in range(iter_warmup + iter_sampling):
+            # 1. User coefficients w_m | mu, s2 ~ N(prec^-1 (Z'Y/sigma2 + mu/s2), prec^-1)
+            precision = data_precision.copy()
+            precision[:, diag, diag] += 1.0 / s2
+            L = np.linalg.cholesky(precision)  # (M, P, P)
+            rhs = data_shift + mu / s2
+            mean = np.linalg.solve(precision, rhs[:, :, None])[:, :, 0]
+            z = rng.standard_normal((M, P, 1))
+            w = mean + np.linalg.solve(np.swapaxes(L, 1, 2), z)[:, :, 0]
+
+            # 2. Population means mu | w, s2
+            mu_precision = M / s2 + 1.0 / MU_PRIOR_SD ** 2
+            mu_mean = (w.sum(axis=0) / s2) / mu_precision
+            mu = mu_mean + rng.standard_normal(P) / np.sqrt(mu_precision)
+
+            # 3. Population variances s2 | w, mu, a and the auxiliary a | s2
+            squares = ((w - mu) ** 2).sum(axis=0)
+            s2 = _inverse_gamma(rng, (M + 1) / 2.0, 1.0 / a + squares / 2.0)
+            a = _inverse_gamma(rng, 1.0, 1.0 / SCALE_PRIOR_SCALE ** 2 + 1.0 / s2)
+
+            if it >= iter_warmup:
+                theta_draws[chain, it - iter_warmup] = w[:, :J]
+                mu_draws[chain, it - iter_warmup] = mu
+                s2_draws[chain, it - iter_warmup] = s2
+
+    if hyper_draws is not None:
+        hyper_draws['mu'] = mu_draws.reshape(chains * iter_sampling, P)
+        hyper_draws['s2'] = s2_draws.reshape(chains * iter_sampling, P)
+    return theta_draws.reshape(chains * iter_sampling, M, J)
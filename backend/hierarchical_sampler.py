@@ -1,9 +1,52 @@
 import numpy as np
-from cmdstanpy import CmdStanModel
+from cmdstanpy import CmdStanModel, write_stan_json
 from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from backend.cpu_budget import CPU_BUDGET, chain_layout, wanted_threads_per_chain
+from backend.file_lock import file_lock
+from backend.gibbs_sampler import gibbs_sample_hierarchical
+from backend.metrics import observe, span
+from backend.posterior_summaries import probability_of_best
+from backend.single_user_sampler import treatment_arms
+
+# INFERENCE BACKENDS
+#   'nuts'        - full MCMC with cmdstanpy (reference)
+#   'variational' - ADVI (cmdstanpy variational), approximate
+#   'pathfinder'  - cmdstanpy pathfinder, approximate
+#   'laplace'     - Gaussian approximation at the posterior mode (cmdstanpy laplace_sample)
+#   'gibbs'       - pure-NumPy blocked Gibbs sampler, exact in the limit, no CmdStan needed
+# The deployment default is set with TONEDOWN_INFERENCE_BACKEND; a call can override it.
+INFERENCE_BACKENDS = ('nuts', 'variational', 'pathfinder', 'laplace', 'gibbs')
+INFERENCE_BACKEND = os.environ.get('TONEDOWN_INFERENCE_BACKEND', 'nuts')
+
+# WARM STARTS
+# NUTS runs reuse the step size, inverse metric and last draws of the previous fit of the same
+# model, so only a short warmup is needed when the data changed by a few rows. The adaptation is
+# kept in memory and on disk next to the compiled model. A warm-started run whose diagnostics
+# degrade (divergences or high R-hat) is repeated with a full warmup.
+WARM_START = os.environ.get('TONEDOWN_WARM_START', '1') == '1'
+WARM_START_WARMUP = 100
+WARM_START_MAX_RHAT = 1.05
+_WARM_STARTS = {}
+
+# PROCESS-WIDE MODEL REGISTRY
+# Compiled models are keyed by the path of the Stan file and a hash of its source, so that
+# every request in a process reuses the same CmdStanModel and the executable is only rebuilt
+# when the model source actually changes.
+MODEL_CACHE_DIR = Path(__file__).parent / '.stan_cache'
+# Built with threading so a chain can evaluate the likelihood with reduce_sum on several cores
+STAN_CPP_OPTIONS = {'STAN_THREADS': True}
+_MODEL_REGISTRY = {}
+_MODEL_REGISTRY_LOCK = threading.Lock()
 
 # AUXILIARY FUNCTION
-def prepare_hierarchical_data(user_data, sigma=1.0):
+def prepare_hierarchical_data(user_data, sigma=1.0, J=None):
     """
     Combine data from multiple users (groups) into a dictionary for Stan.
     
@@ -11,8 +54,10 @@ def prepare_hierarchical_data(user_data, sigma=1.0):
       user_data (list): A list where each element is a tuple (Y, X, D) for one user.
                         Y: (N_i,) outcome vector for user i.
                         X: (N_i, K) covariates matrix for user i.
-                        D: (N_i, J) treatment matrix (one-hot) for user i.
+                        D: (N_i,) treatment arm indices (0-based) or (N_i, J) one-hot
+                           treatment matrix for user i.
       sigma (float): Known noise standard deviation.
+      J (int): Number of treatments; required when D holds arm indices.
     
     Returns:
       dict: A dictionary with keys required by the Stan model.
@@ -21,44 +66,65 @@ def prepare_hierarchical_data(user_data, sigma=1.0):
               - N: Total number of observations
               - K: Number of covariates
               - J: Number of treatments
-              - user: Integer vector (length N) mapping each observation to a user (1-indexed)
+              - user: Integer array (length N) mapping each observation to a user (1-indexed)
               - Y: Outcome vector (length N)
               - X: Covariate matrix (N x K)
-              - D: Treatment indicator matrix (N x J)
+              - arm: Integer array (length N) with the treatment of each observation (1-indexed)
               - sigma: Known noise standard deviation.
+              - grainsize: reduce_sum grain size of the likelihood (1 = automatic).
     """
     M = len(user_data)
-    Y_list, X_list, D_list = [], [], []
-    user_indicator = []  # will hold group indices for each observation (1-indexed)
-    
-    for m, (Y, X, D) in enumerate(user_data, start=1):
-        n = len(Y)
-        Y_list.append(Y)
-        X_list.append(X)
-        D_list.append(D)
-        user_indicator.extend([m] * n)
-    
-    Y_all = np.concatenate(Y_list)
-    X_all = np.vstack(X_list)
-    D_all = np.vstack(D_list)
-    
+    lengths = np.fromiter((len(Y) for Y, _, _ in user_data), dtype=np.int64, count=M)
+    N = int(lengths.sum())
+    K = user_data[0][1].shape[1]
+    _, J = treatment_arms(user_data[0][2], J)
+
+    # Fill preallocated arrays user by user
+    Y_all = np.empty(N)
+    X_all = np.empty((N, K))
+    arm_all = np.empty(N, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    for m, (Y, X, D) in enumerate(user_data):
+        Y_all[offsets[m]:offsets[m + 1]] = Y
+        X_all[offsets[m]:offsets[m + 1]] = X
+        arm_all[offsets[m]:offsets[m + 1]] = treatment_arms(D, J)[0] + 1  # Stan is 1-indexed
+    user_indicator = np.repeat(np.arange(1, M + 1), lengths)  # 1-indexed group of each observation
+
     data = {
         'M': M,
-        'N': len(Y_all),
-        'K': X_all.shape[1],
-        'J': D_all.shape[1],
+        'N': N,
+        'K': K,
+        'J': J,
         'user': user_indicator,   # Stan requires 1-indexed integers
         'Y': Y_all,
         'X': X_all,
-        'D': D_all,
-        'sigma': sigma
+        'arm': arm_all,
+        'sigma': sigma,
+        'grainsize': 1
     }
     return data
 
+# AUXILIARY FUNCTION
+def model_source_hash(stan_path):
+    """
+    Hash the source of a Stan model file.
+
+    Parameters:
+      stan_path (Path): Path to the Stan model file.
+
+    Returns:
+      str: Hex digest of the SHA-256 hash of the model source.
+    """
+    return hashlib.sha256(Path(stan_path).read_bytes()).hexdigest()
+
 # AUXILIARY FUNCTION
 def load_model(stan_file='hier_reg.stan'):
     """
-    Compile the Stan model.
+    Return the compiled Stan model, compiling it at most once per process.
+
+    The model source is copied into a cache directory named after its hash and compiled
+    there, so an executable built by an earlier process is reused as long as the source
+    is unchanged, and an edited model never picks up a stale executable.
     
     Parameters:
       stan_file (str): Name of the Stan model file.
@@ -72,54 +138,478 @@ def load_model(stan_file='hier_reg.stan'):
     
     if not stan_path.exists():
         raise FileNotFoundError(f"Stan model file not found at: {stan_path}")
-        
-    model = CmdStanModel(stan_file=str(stan_path))
+
+    source_hash = model_source_hash(stan_path)
+    key = (str(stan_path), source_hash)
+
+    with _MODEL_REGISTRY_LOCK:
+        model = _MODEL_REGISTRY.get(key)
+        if model is None:
+            # Compile (or pick up the existing executable) in the hash-keyed cache directory
+            cached_dir = MODEL_CACHE_DIR / source_hash[:16]
+            cached_dir.mkdir(parents=True, exist_ok=True)
+            cached_stan = cached_dir / stan_path.name
+            # Other worker processes may be compiling the same model right now
+            with file_lock(cached_dir / '.compile.lock'):
+                if not cached_stan.exists():
+                    shutil.copyfile(stan_path, cached_stan)
+                model = CmdStanModel(stan_file=str(cached_stan), cpp_options=STAN_CPP_OPTIONS)
+            _MODEL_REGISTRY[key] = model
     return model
 
+# AUXILIARY FUNCTION
+def model_is_loaded(stan_file='hier_reg.stan'):
+    """
+    Return True if the current source of the Stan model is compiled and loaded in this process.
+    """
+    stan_path = Path(__file__).parent / stan_file
+    if not stan_path.exists():
+        return False
+    return (str(stan_path), model_source_hash(stan_path)) in _MODEL_REGISTRY
+
+# AUXILIARY FUNCTION
+def warm_up_model(stan_file='hier_reg.stan'):
+    """
+    Compile or load the Stan model ahead of time, e.g. before a server accepts traffic.
+
+    Parameters:
+      stan_file (str): Name of the Stan model file.
+
+    Returns:
+      bool: True if the model is compiled and cached, False if compilation failed.
+    """
+    try:
+        model = load_model(stan_file)
+        print(f"Stan model ready: {model.exe_file}")
+        return True
+    except Exception as e:
+        print(f"Error warming up Stan model: {str(e)}")
+        return False
+
+# STAN DATA FILES
+# cmdstanpy serializes a data dictionary to a temporary JSON file on every call. Instead, the
+# data is written once to .stan_cache/data/<hash>.json, keyed by a hash of its contents, and
+# CmdStan gets the path, so refitting unchanged data skips the serialization. The newest
+# STAN_DATA_CACHE_SIZE files are kept.
+STAN_DATA_DIR = MODEL_CACHE_DIR / 'data'
+STAN_DATA_CACHE_SIZE = int(os.environ.get('TONEDOWN_STAN_DATA_CACHE_SIZE', '16'))
+# Files used within this many seconds are never evicted, so a path handed to a run (possibly
+# of another process) stays valid until CmdStan has read it
+STAN_DATA_GRACE_SECONDS = 600
+
+# AUXILIARY FUNCTION
+def stan_data_hash(data):
+    """
+    Hash the contents of a Stan data dictionary (array bytes, shapes and dtypes).
+    """
+    digest = hashlib.sha256()
+    for key in sorted(data):
+        value = np.ascontiguousarray(data[key])
+        digest.update(f"{key}:{value.dtype.str}:{value.shape};".encode())
+        digest.update(value.tobytes())
+    return digest.hexdigest()
+
+# AUXILIARY FUNCTION
+def stan_data_file(data):
+    """
+    Return the path of a JSON data file for CmdStan, writing it only if it is not cached yet.
+
+    Parameters:
+      data (dict): Output of prepare_hierarchical_data.
+
+    Returns:
+      str: Path of the data file.
+    """
+    STAN_DATA_DIR.mkdir(parents=True, exist_ok=True)
+    path = STAN_DATA_DIR / f"{stan_data_hash(data)[:32]}.json"
+    try:
+        os.utime(path)  # Mark as recently used (fails if the file is missing or was just evicted)
+        return str(path)
+    except FileNotFoundError:
+        pass
+
+    # Write under a temporary name so concurrent readers never see a partial file
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    write_stan_json(str(tmp_path), data)
+    os.replace(tmp_path, path)
+
+    # Drop the least recently used files beyond the cache size, unless they were used recently
+    mtimes = {}
+    for f in STAN_DATA_DIR.glob('*.json'):
+        try:
+            mtimes[f] = f.stat().st_mtime
+        except FileNotFoundError:  # evicted by another process meanwhile
+            pass
+    cutoff = time.time() - STAN_DATA_GRACE_SECONDS
+    for old in sorted(mtimes, key=mtimes.get, reverse=True)[STAN_DATA_CACHE_SIZE:]:
+        if mtimes[old] < cutoff:
+            old.unlink(missing_ok=True)
+    return str(path)
+
+# AUXILIARY FUNCTION
+def split_rhat(draws, chains):
+    """
+    Compute the split R-hat of every scalar in a stack of multi-chain draws.
+
+    Parameters:
+      draws (np.ndarray): (chains*n, ...) draws with chains stacked in order.
+      chains (int): Number of chains.
+
+    Returns:
+      np.ndarray: R-hat with the trailing shape of draws.
+    """
+    n = draws.shape[0] // chains
+    half = n // 2
+    per_chain = draws[:chains * n].reshape((chains, n) + draws.shape[1:])
+    # Split every chain in two halves
+    split = np.concatenate([per_chain[:, :half], per_chain[:, half:2 * half]], axis=0)
+    chain_means = split.mean(axis=1)
+    within = split.var(axis=1, ddof=1).mean(axis=0)
+    between = half * chain_means.var(axis=0, ddof=1)
+    var_plus = (half - 1) / half * within + between / half
+    return np.sqrt(var_plus / within)
+
+# AUXILIARY FUNCTION
+def _warm_start_path(stan_file):
+    """
+    Path of the persisted warm-start state of a model.
+    """
+    source_hash = model_source_hash(Path(__file__).parent / stan_file)
+    return MODEL_CACHE_DIR / source_hash[:16] / 'warm_start.json'
+
+def load_warm_start(stan_file='hier_reg.stan'):
+    """
+    Return the adaptation and last draws of the previous NUTS fit of a model, or None.
+    """
+    path = _warm_start_path(stan_file)
+    state = _WARM_STARTS.get(path)
+    if state is None and path.exists():
+        try:
+            state = json.loads(path.read_text())
+            _WARM_STARTS[path] = state
+        except (OSError, ValueError):
+            state = None
+    return state
+
+def save_warm_start(stan_file, fit, data, iter_sampling):
+    """
+    Persist the step sizes, inverse metrics and last draws of every chain of a NUTS fit.
+    """
+    last = [(c + 1) * iter_sampling - 1 for c in range(fit.chains)]
+    variables = fit.stan_variables()
+    state = {
+        'M': data['M'], 'J': data['J'], 'K': data['K'],
+        'step_size': [float(x) for x in np.atleast_1d(fit.step_size)],
+        'inv_metric': [np.asarray(m).tolist() for m in fit.inv_metric],
+        'inits': [{name: np.asarray(values[i]).tolist() for name, values in variables.items()}
+                  for i in last],
+    }
+    path = _warm_start_path(stan_file)
+    _WARM_STARTS[path] = state
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(state))
+    except OSError as e:
+        print(f"Could not persist warm start: {str(e)}")
+
+def _resize_rows(values, M):
+    """
+    Resize the user rows of a (M_old, P) draw to M rows, filling new users with the mean row.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.shape[0] >= M:
+        return values[:M]
+    fill = np.repeat(values.mean(axis=0, keepdims=True), M - values.shape[0], axis=0)
+    return np.vstack([values, fill])
+
+def _resize_inv_metric(inv_metric, M_old, M, J, K):
+    """
+    Resize a diagonal inverse metric to M users. Stan orders the unconstrained parameters as
+    theta (column-major M x J), beta (column-major M x K), mu_theta, sigma_theta, mu_beta, sigma_beta.
+    """
+    inv_metric = np.asarray(inv_metric, dtype=float)
+    theta = inv_metric[:M_old * J].reshape(J, M_old).T
+    beta = inv_metric[M_old * J:M_old * (J + K)].reshape(K, M_old).T
+    rest = inv_metric[M_old * (J + K):]
+    return np.concatenate([
+        _resize_rows(theta, M).T.ravel(), _resize_rows(beta, M).T.ravel(), rest
+    ])
+
+def warm_start_arguments(state, data, chains):
+    """
+    Build the inits, inv_metric and step_size arguments of model.sample from a warm-start
+    state, each a list with one entry per chain.
+
+    Returns:
+      dict or None: Keyword arguments for model.sample, or None if the state does not fit
+                    the data (different treatments, covariates or a dense metric).
+    """
+    if state is None or state['J'] != data['J'] or state['K'] != data['K']:
+        return None
+    M_old, M = state['M'], data['M']
+    n_params = M_old * (state['J'] + state['K']) + 2 * (state['J'] + state['K'])
+    if any(np.ndim(m) != 1 or len(m) != n_params for m in state['inv_metric']):
+        return None
+
+    inits, inv_metric, step_size = [], [], []
+    for c in range(chains):
+        # Reuse the previous chains cyclically if the number of chains changed
+        prev = c % len(state['inits'])
+        init = dict(state['inits'][prev])
+        init['theta'] = _resize_rows(init['theta'], M).tolist()
+        init['beta'] = _resize_rows(init['beta'], M).tolist()
+        inits.append(init)
+        inv_metric.append(_resize_inv_metric(
+            state['inv_metric'][prev], M_old, M, data['J'], data['K']))
+        step_size.append(state['step_size'][prev])
+    return {'inits': inits, 'inv_metric': inv_metric, 'step_size': step_size}
+
+def sample_nuts(model, data, stan_file='hier_reg.stan', iter_sampling=1000, iter_warmup=500,
+                chains=4, diagnostics=None, warm_start=WARM_START, parallel_chains=None,
+                threads_per_chain=1, data_file=None, hyper_draws=None):
+    """
+    Run NUTS, warm-started from the previous fit of the model when possible.
+
+    Parameters:
+      model (CmdStanModel): The compiled model.
+      data (dict): Output of prepare_hierarchical_data.
+      stan_file (str): Name of the Stan model file (identifies the warm-start state).
+      iter_sampling (int): Number of sampling iterations per chain.
+      iter_warmup (int): Number of warmup iterations of a cold start.
+      chains (int): Number of chains.
+      diagnostics (dict): Optional dictionary that is filled with diagnostics.
+      warm_start (bool): Whether to reuse (and update) the warm-start state.
+      parallel_chains (int): Chains run at the same time (defaults to all chains).
+      threads_per_chain (int): reduce_sum threads within each chain.
+      data_file (str): Optional path of the data as a JSON file (see stan_data_file).
+      hyper_draws (dict): Optional dictionary that is filled with population draws, see
+                          sample_theta.
+
+    Returns:
+      np.ndarray: (iter_sampling*chains, M, J) draws of theta.
+    """
+    if diagnostics is None:
+        diagnostics = {}
+    warm_args = warm_start_arguments(load_warm_start(stan_file), data, chains) if warm_start else None
+    parallel = {'parallel_chains': parallel_chains or chains, 'threads_per_chain': threads_per_chain}
+    stan_data = data_file or data
+
+    fit = None
+    if warm_args is not None:
+        fit = model.sample(data=stan_data, iter_sampling=iter_sampling,
+                           iter_warmup=WARM_START_WARMUP, chains=chains, **parallel, **warm_args)
+        theta_draws = fit.stan_variable("theta")
+        divergences = int(np.sum(fit.divergences))
+        max_rhat = float(np.nanmax(split_rhat(theta_draws, chains)))
+        diagnostics['warm_started'] = True
+        if divergences > 0 or max_rhat > WARM_START_MAX_RHAT:
+            # Diagnostics degraded: fall back to a full warmup
+            print(f"Warm start degraded (divergences={divergences}, max_rhat={max_rhat:.3f}); "
+                  f"rerunning with full warmup")
+            diagnostics['warm_start_fallback'] = True
+            fit = None
+
+    if fit is None:
+        fit = model.sample(data=stan_data, iter_sampling=iter_sampling, iter_warmup=iter_warmup,
+                           chains=chains, **parallel)
+        theta_draws = fit.stan_variable("theta") # (n_draws*n_chains, M, J)
+        diagnostics.setdefault('warm_started', False)
+
+    diagnostics['divergences'] = int(np.sum(fit.divergences))
+    diagnostics['max_rhat'] = float(np.nanmax(split_rhat(theta_draws, chains)))
+    if warm_start:
+        save_warm_start(stan_file, fit, data, iter_sampling)
+    _stan_hyper_draws(fit, hyper_draws)
+    return theta_draws
+
+def _stan_hyper_draws(fit, hyper_draws, **kwargs):
+    # Fill hyper_draws with the population means and variances of [theta; beta]
+    if hyper_draws is None:
+        return
+    hyper_draws['mu'] = np.hstack([fit.stan_variable('mu_theta', **kwargs),
+                                   fit.stan_variable('mu_beta', **kwargs)])
+    hyper_draws['s2'] = np.hstack([fit.stan_variable('sigma_theta', **kwargs),
+                                   fit.stan_variable('sigma_beta', **kwargs)]) ** 2
+
+# AUXILIARY FUNCTION
+def sample_theta(data, method, stan_file='hier_reg.stan', iter_sampling=1000, iter_warmup=500,
+                 chains=4, diagnostics=None, hyper_draws=None):
+    """
+    Draw from the posterior of theta with the chosen inference backend.
+
+    The run first reserves cores from CPU_BUDGET and queues until its minimum is free. NUTS
+    asks for one core per chain plus within-chain threads on large datasets and runs with the
+    granted parallel_chains and threads_per_chain; the other backends use a single core.
+
+    Parameters:
+      data (dict): Output of prepare_hierarchical_data.
+      method (str): One of INFERENCE_BACKENDS.
+      stan_file (str): Name of the Stan model file.
+      iter_sampling (int): Number of sampling iterations per chain.
+      iter_warmup (int): Number of warmup iterations per chain (MCMC backends only).
+      chains (int): Number of chains; the approximate backends return iter_sampling*chains draws.
+      diagnostics (dict): Optional dictionary that is filled with backend diagnostics.
+      hyper_draws (dict): Optional dictionary that is filled with the matching draws of the
+                          population means 'mu' and variances 's2' of [theta; beta], each
+                          of shape (n_draws, J+K).
+
+    Returns:
+      np.ndarray: (iter_sampling*chains, M, J) draws of theta.
+    """
+    if diagnostics is None:
+        diagnostics = {}
+
+    if method == 'nuts':
+        wanted = chains * wanted_threads_per_chain(data['N'])
+        minimum = step = chains
+    else:
+        wanted = minimum = step = 1
+
+    queued_at = time.perf_counter()
+    with CPU_BUDGET.reserve(wanted, minimum=minimum, step=step) as cores:
+        observe('cpu_queue', time.perf_counter() - queued_at)
+        diagnostics['cores'] = cores
+        if method == 'gibbs':
+            with span('sampling'):
+                theta_draws = gibbs_sample_hierarchical(
+                    data, iter_sampling=iter_sampling, iter_warmup=iter_warmup, chains=chains,
+                    hyper_draws=hyper_draws
+                )
+            diagnostics['max_rhat'] = float(np.nanmax(split_rhat(theta_draws, chains)))
+            return theta_draws
+
+        with span('model_load'):
+            model = load_model(stan_file)
+        with span('sampling'):
+            return _sample_stan(model, data, method, stan_file, iter_sampling, iter_warmup, chains,
+                                diagnostics, cores, hyper_draws)
+
+def _sample_stan(model, data, method, stan_file, iter_sampling, iter_warmup, chains, diagnostics,
+                 cores=1, hyper_draws=None):
+    """
+    Body of sample_theta for the CmdStan backends.
+    """
+    n_draws = iter_sampling * chains
+    with span('stan_data_write'):
+        data_file = stan_data_file(data)
+    if method == 'nuts':
+        parallel_chains, threads_per_chain = chain_layout(cores, chains)
+        diagnostics['parallel_chains'] = parallel_chains
+        diagnostics['threads_per_chain'] = threads_per_chain
+        theta_draws = sample_nuts(
+            model, data, stan_file=stan_file, iter_sampling=iter_sampling,
+            iter_warmup=iter_warmup, chains=chains, diagnostics=diagnostics,
+            parallel_chains=parallel_chains, threads_per_chain=threads_per_chain,
+            data_file=data_file, hyper_draws=hyper_draws
+        )
+    elif method == 'variational':
+        fit = model.variational(data=data_file, output_samples=n_draws, require_converged=False)
+        theta_draws = fit.stan_variable("theta", mean=False)
+        _stan_hyper_draws(fit, hyper_draws, mean=False)
+    elif method == 'pathfinder':
+        fit = model.pathfinder(data=data_file, draws=n_draws)
+        theta_draws = fit.stan_variable("theta")
+        _stan_hyper_draws(fit, hyper_draws)
+    elif method == 'laplace':
+        fit = model.laplace_sample(data=data_file, draws=n_draws)
+        theta_draws = fit.stan_variable("theta")
+        _stan_hyper_draws(fit, hyper_draws)
+    else:
+        raise ValueError(f"Unknown inference backend '{method}', expected one of {INFERENCE_BACKENDS}")
+    return theta_draws
+
 # MAIN ENTRY POINT
 def run_hierarchical_model(user_data, stan_file='hier_reg.stan',
-                           sigma=1.0, iter_sampling=1000, iter_warmup=500, chains=4):
+                           sigma=1.0, iter_sampling=1000, iter_warmup=500, chains=4,
+                           method=None, diagnostics=None, J=None, hyper_draws=None):
     """
     Prepare data from multiple users, compile, and run the Stan model.
     
     Parameters:
-      user_data (list): List of tuples (Y, X, D) for each user.
+      user_data (list): List of tuples (Y, X, D) for each user, see prepare_hierarchical_data.
       stan_file (str): Name of the Stan model file.
       sigma (float): Known noise standard deviation.
       iter_sampling (int): Number of sampling iterations.
       iter_warmup (int): Number of warmup iterations.
       chains (int): Number of MCMC chains.
+      method (str): Inference backend, one of INFERENCE_BACKENDS. Defaults to INFERENCE_BACKEND.
+      diagnostics (dict): Optional dictionary that is filled with the backend used, the
+                          wall time and backend diagnostics (divergences, R-hat).
+      J (int): Number of treatments; required when D holds arm indices.
+      hyper_draws (dict): Optional dictionary that is filled with population draws, see
+                          sample_theta (left empty if sampling fails).
     
     Returns:
       tuple: (theta_draws, proportions) containing the posterior samples and best arm proportions
     """
+    if method is None:
+        method = INFERENCE_BACKEND
+    if diagnostics is None:
+        diagnostics = {}
+    diagnostics['method'] = method
+    start = time.perf_counter()
     try:
-        data = prepare_hierarchical_data(user_data, sigma=sigma)
-        model = load_model(stan_file)
-        fit = model.sample(data=data, iter_sampling=iter_sampling, iter_warmup=iter_warmup, chains=chains)
+        with span('stan_data_prep'):
+            data = prepare_hierarchical_data(user_data, sigma=sigma, J=J)
+        theta_draws = sample_theta(
+            data, method, stan_file=stan_file, iter_sampling=iter_sampling,
+            iter_warmup=iter_warmup, chains=chains, diagnostics=diagnostics,
+            hyper_draws=hyper_draws
+        )
 
-        theta_draws = fit.stan_variable("theta") # (n_draws*n_chains, M, J)
-
-        M = theta_draws.shape[1]
-        J = theta_draws.shape[2]
-        proportions = np.empty((M, J))
-        for m in range(M):
-            # For user m, find which treatment has the maximum effect for each draw
-            best_arm = np.argmax(theta_draws[:, m, :], axis=1)
-            counts = np.bincount(best_arm, minlength=J)
-            proportions[m, :] = counts / (iter_sampling*chains)
+        with span('best_arm_probability'):
+            # One batched reduction over all users, divided by the draws actually returned
+            proportions = probability_of_best(theta_draws)
 
+        diagnostics['seconds'] = time.perf_counter() - start
         return theta_draws, proportions
       
     except Exception as e:
         print(f"Error in hierarchical sampling: {str(e)}")
+        diagnostics['error'] = str(e)
+        diagnostics['seconds'] = time.perf_counter() - start
+        if hyper_draws is not None:
+            hyper_draws.clear()
         # Fallback to uniform distribution if sampling fails
         M = len(user_data)
-        J = user_data[0][2].shape[1]  # Get number of treatments from first user's data
+        _, J = treatment_arms(user_data[0][2], J)  # Number of treatments
         theta_draws = np.random.normal(0, 1, (iter_sampling*chains, M, J))
         proportions = np.ones((M, J)) / J  # Uniform distribution
         return theta_draws, proportions
 
+def compare_inference_backends(user_data, methods=INFERENCE_BACKENDS, reference='nuts', **kwargs):
+    """
+    Run several inference backends on the same data and compare them against a reference.
+
+    Parameters:
+      user_data (list): List of tuples (Y, X, D) for each user.
+      methods (iterable): Backends to compare.
+      reference (str): Backend used as ground truth (NUTS by default).
+      **kwargs: Passed on to run_hierarchical_model.
+
+    Returns:
+      dict: For each backend, its diagnostics (including 'seconds') plus the largest absolute
+            difference of the best-arm probabilities ('max_abs_prob_diff') and of the
+            posterior means of theta ('max_abs_mean_diff') from the reference.
+    """
+    runs = {}
+    for method in dict.fromkeys([reference] + list(methods)):
+        diagnostics = {}
+        theta_draws, proportions = run_hierarchical_model(
+            user_data, method=method, diagnostics=diagnostics, **kwargs
+        )
+        runs[method] = (theta_draws, proportions, diagnostics)
+
+    ref_draws, ref_proportions, _ = runs[reference]
+    report = {}
+    for method, (theta_draws, proportions, diagnostics) in runs.items():
+        report[method] = dict(diagnostics)
+        report[method]['max_abs_prob_diff'] = float(np.max(np.abs(proportions - ref_proportions)))
+        report[method]['max_abs_mean_diff'] = float(
+            np.max(np.abs(theta_draws.mean(axis=0) - ref_draws.mean(axis=0)))
+        )
+    return report
+
 # # Example usage:
 # if __name__ == '__main__':
 #     # Suppose we have data for M=5 users
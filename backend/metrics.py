@@ -0,0 +1,156 @@
+## STAGE TIMING INSTRUMENTATION
+## Code on the analysis and upload paths wraps its stages in `span(stage)`; every span records
+## its duration in a process-wide histogram that is exported in the Prometheus text format.
+## Spans run in many processes (gunicorn workers, their job pool workers, background refits),
+## so every process also writes its histograms to a file of its own in TONEDOWN_METRICS_DIR,
+## and the export sums the files of all processes, including those that have exited. Clear
+## the directory when the server starts (clear_metrics_dir). With an empty
+## TONEDOWN_METRICS_DIR, only the spans of the exporting process are exported.
+
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Directory of the per-process histogram files shared by all processes of the host
+METRICS_DIR = os.environ.get('TONEDOWN_METRICS_DIR',
+                             os.path.join(tempfile.gettempdir(), 'tonedown-metrics'))
+
+_STAGES = {}  # stage -> {'count', 'sum', 'buckets'}
+_LOCK = threading.Lock()
+_PROCESS = {'pid': None, 'file': None}  # histogram file of this process
+
+def observe(stage, seconds):
+    """
+    Record one duration of a stage.
+
+    Parameters:
+      stage (str): Stage name, e.g. 'sampling'.
+      seconds (float): Duration in seconds.
+    """
+    with _LOCK:
+        _check_process()
+        stats = _STAGES.get(stage)
+        if stats is None:
+            stats = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)}
+            _STAGES[stage] = stats
+        stats['count'] += 1
+        stats['sum'] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+        _write_process_file()
+
+@contextmanager
+def span(stage):
+    """
+    Time the enclosed block and record it under the stage name (also when it raises).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def snapshot():
+    """
+    Return a copy of the statistics recorded by this process, stage -> {'count', 'sum', 'buckets'}.
+    """
+    with _LOCK:
+        _check_process()
+        return _copy(_STAGES)
+
+def collect():
+    """
+    Return the statistics summed over all processes that share METRICS_DIR, in the format of
+    snapshot. Without METRICS_DIR, the statistics of this process.
+    """
+    if not METRICS_DIR:
+        return snapshot()
+    with _LOCK:
+        _check_process()
+        own_file = _PROCESS['file']
+        totals = _copy(_STAGES)
+    for path in Path(METRICS_DIR).glob('*.json'):
+        if path == own_file:
+            continue
+        try:
+            stages = json.loads(path.read_text())
+        except (OSError, ValueError):  # removed by clear_metrics_dir meanwhile
+            continue
+        for stage, stats in stages.items():
+            total = totals.setdefault(stage, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)})
+            total['count'] += stats['count']
+            total['sum'] += stats['sum']
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], stats['buckets'])]
+    return totals
+
+def reset():
+    """
+    Drop all statistics recorded by this process.
+    """
+    with _LOCK:
+        _check_process()
+        _STAGES.clear()
+        if _PROCESS['file'] is not None:
+            _PROCESS['file'].unlink(missing_ok=True)
+
+def clear_metrics_dir():
+    """
+    Remove the histogram files of all processes, e.g. when the server starts.
+    """
+    if METRICS_DIR:
+        for path in Path(METRICS_DIR).glob('*.json'):
+            path.unlink(missing_ok=True)
+
+def render_prometheus(prefix='tonedown'):
+    """
+    Render the stage histograms in the Prometheus text exposition format.
+    """
+    name = f"{prefix}_stage_duration_seconds"
+    lines = [
+        f"# HELP {name} Duration of the stages of the analysis and upload paths.",
+        f"# TYPE {name} histogram",
+    ]
+    for stage, stats in sorted(collect().items()):
+        for bound, count in zip(BUCKETS, stats['buckets']):
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {stats["count"]}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {stats["sum"]}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+    return '\n'.join(lines) + '\n'
+
+# AUXILIARY FUNCTIONS
+def _copy(stages):
+    return {stage: {'count': s['count'], 'sum': s['sum'], 'buckets': list(s['buckets'])}
+            for stage, s in stages.items()}
+
+def _check_process():
+    # A forked child starts with empty statistics and a file of its own (lock held). The file
+    # name is unique per process, so a reused pid does not overwrite an exited process's file.
+    pid = os.getpid()
+    if _PROCESS['pid'] != pid:
+        if _PROCESS['pid'] is not None:
+            _STAGES.clear()
+        _PROCESS['pid'] = pid
+        _PROCESS['file'] = (Path(METRICS_DIR) / f'{pid}-{uuid.uuid4().hex[:8]}.json'
+                            if METRICS_DIR else None)
+
+def _write_process_file():
+    # Replace this process's histogram file with the current statistics (lock held)
+    path = _PROCESS['file']
+    if path is None:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(_STAGES))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error writing metrics file {path}: {str(e)}")
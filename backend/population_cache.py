@@ -0,0 +1,236 @@
+## CACHE OF POPULATION-LEVEL HIERARCHICAL FITS
+## In shared mode every user is part of the same hierarchical model, so one fit over all
+## shared users answers every shared user's request. Fits are cached by dataset revision;
+## a fit that is a few revisions behind is still served until it exceeds the staleness
+## threshold. A served fit is refreshed in the background once it lags a few revisions or
+## has aged, with at most one refit in flight, so uploads do not trigger a refit each.
+## Failed fits (uniform fallback probabilities) are never cached.
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from backend.draw_store import save_draws
+from backend.hierarchical_sampler import run_hierarchical_model
+from backend.subsampling import MAX_USERS, fit_subsampled_hierarchical_model, subsampling_enabled
+
+# Seconds after which a fit is too old to be served
+POPULATION_FIT_TTL = float(os.environ.get('TONEDOWN_POPULATION_TTL', '3600'))
+# Number of revisions a fit may lag behind the data before a request waits for a refit
+POPULATION_MAX_REVISION_LAG = int(os.environ.get('TONEDOWN_POPULATION_MAX_LAG', '10'))
+# A stale fit that lags this many revisions, or is this many seconds old, is refreshed in the background
+POPULATION_REFRESH_LAG = int(os.environ.get('TONEDOWN_POPULATION_REFRESH_LAG', '3'))
+POPULATION_REFRESH_SECONDS = float(os.environ.get('TONEDOWN_POPULATION_REFRESH_SECONDS', '300'))
+# Number of fits kept in memory (least recently used are evicted)
+POPULATION_CACHE_SIZE = int(os.environ.get('TONEDOWN_POPULATION_CACHE_SIZE', '2'))
+
+# MAIN FIT FUNCTION
+def fit_population(user_index, iter_sampling=1200, **kwargs):
+    """
+    Fit the hierarchical model on all shared users.
+
+    The draws are written to the draw store and only a lazy accessor is kept, so a cached fit
+    holds the best-arm probabilities in memory and pages in a user's draws when they are read.
+    Populations of more than MAX_USERS users are fitted on a stratified subsample; the fit
+    keeps the SubsampledFit, which draws the other users when they are read (see subsampling),
+    so nothing is computed or stored per user up front.
+
+    Parameters:
+      user_index (dict): Output of extract_all_user_data, uid -> (is_private, (Y, X, arm)).
+      iter_sampling (int): Number of sampling iterations.
+      **kwargs: Passed on to run_hierarchical_model.
+
+    Returns:
+      dict: The fit with 'uids' (row order), 'row_of' (uid -> row), 'fit_id', 'draws'
+            (StoredDraws, see draw_store, or SubsampledFit; both have user_draws(m)),
+            'proportions' ((M, J), or None for a SubsampledFit, see fit_proportions) and
+            'error' (the sampling error if the model fell back to uniform probabilities,
+            else None).
+    """
+    diagnostics = kwargs.pop('diagnostics', None)
+    if diagnostics is None:
+        diagnostics = {}
+    uids = sorted(uid for uid, (is_private, _) in user_index.items() if not is_private)
+    group_data = [user_index[uid][1] for uid in uids]
+    if subsampling_enabled(len(group_data)):
+        fit = fit_subsampled_hierarchical_model(group_data, max_users=MAX_USERS,
+                                                strategy='stratified', iter_sampling=iter_sampling,
+                                                diagnostics=diagnostics, **kwargs)
+        draws, proportions = fit, None
+    else:
+        theta_draws, proportions = run_hierarchical_model(group_data, iter_sampling=iter_sampling,
+                                                          diagnostics=diagnostics, **kwargs)
+        draws = save_draws(theta_draws)
+    return {
+        'uids': uids,
+        'row_of': {uid: m for m, uid in enumerate(uids)},
+        'fit_id': draws.fit_id,
+        'draws': draws,
+        'proportions': proportions,
+        'error': diagnostics.get('error'),
+    }
+
+def fit_proportions(fit, rows):
+    """
+    Return the (len(rows), J) best-arm probabilities of the given rows of a fit from
+    fit_population.
+    """
+    if fit['proportions'] is None:
+        return fit['draws'].user_proportions(rows)
+    return fit['proportions'][rows]
+
+class PopulationFitCache:
+    """
+    Revision-keyed cache of population fits with TTL and LRU eviction.
+
+    A request for revision r is served from the fit for r if there is one, otherwise from
+    the newest fit that lags at most max_revision_lag revisions, is younger than ttl_seconds
+    and contains the user. A served stale fit that lags at least refresh_lag revisions or is
+    older than refresh_seconds triggers a refit for r in the background. Only when no fit
+    qualifies does the request wait for a refit. At most one fit runs at a time; requests
+    that need one while it runs wait for it and share its outcome - the fit, the uniform
+    fallback of a failed fit or the raised error - so a fit of a revision runs once however
+    many requests wait for it. Failed fits are handed to the waiting requests but not cached.
+    """
+
+    def __init__(self, max_entries=POPULATION_CACHE_SIZE, ttl_seconds=POPULATION_FIT_TTL,
+                 max_revision_lag=POPULATION_MAX_REVISION_LAG, refresh_lag=POPULATION_REFRESH_LAG,
+                 refresh_seconds=POPULATION_REFRESH_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_revision_lag = max_revision_lag
+        self.refresh_lag = refresh_lag
+        self.refresh_seconds = refresh_seconds
+        self._fits = OrderedDict()   # revision -> (fitted_at, fit)
+        self._fitting = None         # _FitRun of the in-flight fit or None
+        self._lock = threading.Lock()
+
+    def get_user_fit(self, user_id, revision, fit_fn, exact=False):
+        """
+        Return a population fit that contains the user.
+
+        Parameters:
+          user_id (str): The requesting (shared) user.
+          revision: Dataset revision of the current data (comparable, e.g. an int).
+          fit_fn (callable): Function with no arguments that fits the current data and
+                             returns the output of fit_population.
+          exact (bool): Only return a fit of this very revision, e.g. for results that are
+                        stored under the revision; waits for the refit if necessary.
+
+        Returns:
+          dict: A fit from fit_population, possibly for an earlier revision.
+
+        Raises:
+          Exception: The error raised by fit_fn in the fit this request ran or waited for.
+        """
+        while True:
+            with self._lock:
+                self._evict_expired()
+                fit = self._usable_fit(user_id, revision, 0 if exact else self.max_revision_lag)
+                if fit is not None:
+                    fit_revision, fitted_at, fit_data = fit
+                    if self._fitting is None and self._needs_refresh(fit_revision, fitted_at, revision):
+                        # Serve the stale fit and refresh it in the background
+                        self._start_fit(revision, fit_fn, background=True)
+                    return fit_data
+                if self._fitting is None:
+                    run = self._start_fit(revision, fit_fn, background=False)
+                    owner = True
+                else:
+                    run = self._fitting
+                    owner = False
+
+            if owner:
+                self._run_fit(run, fit_fn)
+            else:
+                run.event.wait()
+                if run.revision != revision:
+                    # A fit of another revision ended; check the cache again
+                    continue
+
+            # Hand out the outcome of the fit of this revision
+            if run.error is not None:
+                raise run.error
+            if user_id in run.fit['row_of']:
+                return run.fit
+            if owner:
+                # The fit predates the user; fit synchronously
+                return fit_fn()
+            # Check the cache again, so that at most one waiter refits
+
+    def clear(self):
+        """
+        Drop all cached fits.
+        """
+        with self._lock:
+            self._fits.clear()
+
+    def _usable_fit(self, user_id, revision, max_revision_lag):
+        # Newest fit within the staleness threshold that contains the user (lock held)
+        for fit_revision in sorted(self._fits, reverse=True):
+            if fit_revision > revision or revision - fit_revision > max_revision_lag:
+                continue
+            fitted_at, fit = self._fits[fit_revision]
+            if user_id in fit['row_of']:
+                self._fits.move_to_end(fit_revision)
+                return fit_revision, fitted_at, fit
+        return None
+
+    def _needs_refresh(self, fit_revision, fitted_at, revision):
+        # Whether a served fit is stale enough for a background refit
+        if fit_revision == revision:
+            return False
+        return (revision - fit_revision >= self.refresh_lag
+                or time.time() - fitted_at >= self.refresh_seconds)
+
+    def _start_fit(self, revision, fit_fn, background):
+        # Register the in-flight fit (lock held)
+        run = _FitRun(revision)
+        self._fitting = run
+        if background:
+            threading.Thread(target=self._run_fit, args=(run, fit_fn), daemon=True).start()
+        return run
+
+    def _run_fit(self, run, fit_fn):
+        # Run a fit, record its outcome in run and cache it unless it failed
+        try:
+            run.fit = fit_fn()
+            if run.fit.get('error') is not None:
+                print(f"Population fit for revision {run.revision} failed and is not cached: "
+                      f"{run.fit['error']}")
+            else:
+                with self._lock:
+                    self._fits[run.revision] = (time.time(), run.fit)
+                    self._fits.move_to_end(run.revision)
+                    while len(self._fits) > self.max_entries:
+                        self._fits.popitem(last=False)
+        except Exception as e:
+            print(f"Error fitting population model for revision {run.revision}: {str(e)}")
+            run.error = e
+        finally:
+            with self._lock:
+                self._fitting = None
+            run.event.set()
+
+    def _evict_expired(self):
+        # Drop fits older than the TTL (lock held)
+        now = time.time()
+        for fit_revision in [r for r, (fitted_at, _) in self._fits.items()
+                             if now - fitted_at > self.ttl_seconds]:
+            del self._fits[fit_revision]
+
+class _FitRun:
+    """
+    An in-flight population fit: its revision and, once event is set, its outcome (the fit,
+    or the error fit_fn raised).
+    """
+
+    def __init__(self, revision):
+        self.revision = revision
+        self.event = threading.Event()
+        self.fit = None
+        self.error = None
+
+# Process-wide cache used by backend_call
+POPULATION_CACHE = PopulationFitCache()
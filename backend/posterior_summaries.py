@@ -0,0 +1,86 @@
+## RANKING SUMMARIES OF TREATMENT EFFECT DRAWS
+## Reduces posterior draws of theta, (n_draws, M, J) for M users or (n_draws, J) for one user,
+## to per-user, per-treatment summaries in one batched pass without a loop over users:
+##   - probability of being the best treatment,
+##   - expected regret E[max_i theta_i - theta_j] of choosing treatment j,
+##   - probability of being among the k best treatments.
+## The draws are processed in chunks of at most DRAW_CHUNK_ELEMENTS values, so the temporary
+## arrays stay bounded for large populations. Probabilities are divided by the number of draws
+## actually passed in, which need not be iter_sampling*chains (thinning, failed chains).
+
+import numpy as np
+
+# Values of theta_draws processed per chunk (about 32 MB of float64 temporaries)
+DRAW_CHUNK_ELEMENTS = 1 << 22
+
+def _draw_chunks(n_draws, values_per_draw, chunk_elements):
+    # Slices over the draw axis with at most chunk_elements values each
+    step = max(1, chunk_elements // max(1, values_per_draw))
+    for start in range(0, n_draws, step):
+        yield slice(start, min(start + step, n_draws))
+
+def ranking_summaries(theta_draws, regret=True, top_k=(), chunk_elements=DRAW_CHUNK_ELEMENTS):
+    """
+    Compute ranking summaries of every user's treatments from posterior draws.
+
+    Parameters:
+      theta_draws (np.ndarray): (n_draws, M, J) draws for M users, or (n_draws, J) for one.
+      regret (bool): Also compute the expected regret.
+      top_k (iterable): Values of k for which P(treatment is among the k best) is computed.
+      chunk_elements (int): Upper bound on the values processed at once.
+
+    Returns:
+      dict: 'n_draws', 'prob_best' (M, J), and if requested 'expected_regret' (M, J) and
+            'top_k' (k -> (M, J)); the user axis is dropped for (n_draws, J) input.
+    """
+    theta_draws = np.asarray(theta_draws)
+    single_user = theta_draws.ndim == 2
+    if single_user:
+        theta_draws = theta_draws[:, None, :]
+    n_draws, M, J = theta_draws.shape
+    top_k = sorted(set(int(k) for k in top_k))
+
+    best_counts = np.zeros(M * J)
+    regret_sums = np.zeros((M, J))
+    top_k_counts = {k: np.zeros((M, J)) for k in top_k}
+    offsets = np.arange(M) * J
+
+    for chunk in _draw_chunks(n_draws, M * J, chunk_elements):
+        draws = theta_draws[chunk]  # (s, M, J)
+        best = np.argmax(draws, axis=2)  # (s, M)
+        # One bincount over (user, arm) cells instead of one per user
+        best_counts += np.bincount((best + offsets).ravel(), minlength=M * J)
+        if regret:
+            best_values = np.take_along_axis(draws, best[:, :, None], axis=2)
+            regret_sums += (best_values - draws).sum(axis=0)
+        if top_k:
+            # Rank of every arm within its draw, 0 = largest
+            ranks = np.argsort(np.argsort(-draws, axis=2), axis=2)
+            for k in top_k:
+                top_k_counts[k] += (ranks < k).sum(axis=0)
+
+    result = {'n_draws': n_draws, 'prob_best': best_counts.reshape(M, J) / n_draws}
+    if regret:
+        result['expected_regret'] = regret_sums / n_draws
+    if top_k:
+        result['top_k'] = {k: counts / n_draws for k, counts in top_k_counts.items()}
+
+    if single_user:
+        result['prob_best'] = result['prob_best'][0]
+        if regret:
+            result['expected_regret'] = result['expected_regret'][0]
+        if top_k:
+            result['top_k'] = {k: p[0] for k, p in result['top_k'].items()}
+    return result
+
+def probability_of_best(theta_draws, chunk_elements=DRAW_CHUNK_ELEMENTS):
+    """
+    Fraction of draws in which each treatment has the largest effect, per user.
+
+    Parameters:
+      theta_draws (np.ndarray): (n_draws, M, J) or (n_draws, J) draws.
+
+    Returns:
+      np.ndarray: (M, J) or (J,) probabilities; arms that never win get 0.
+    """
+    return ranking_summaries(theta_draws, regret=False, chunk_elements=chunk_elements)['prob_best']
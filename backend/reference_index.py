@@ -0,0 +1,120 @@
+## ECDF REFERENCE INDEX FOR GAUSSIANIZING OUTCOMES
+## Gaussianization maps a value x to norm.ppf(F(x)), with F the ECDF of a reference sample.
+## The reference is kept as its sorted distinct values with cumulative counts, so transforming
+## any number of values is a single searchsorted, and new reference values are merged in
+## without re-sorting the whole sample. Beyond max_size distinct values the index is
+## compressed into a quantile sketch of at most max_size points; its ECDF is then off by
+## about 1/max_size (a little more after repeated compressions).
+
+import numpy as np
+from scipy.stats import norm
+
+# Default number of points of the quantile sketch
+SKETCH_SIZE = 4096
+
+class ReferenceIndex:
+    """
+    Sorted, incrementally maintained reference sample for ECDF and Gaussian transforms.
+
+    Parameters:
+      values: Optional initial reference values (NaN values are ignored).
+      max_size (int): Number of points above which the index becomes a quantile sketch;
+                      None keeps it exact.
+    """
+
+    def __init__(self, values=None, max_size=SKETCH_SIZE):
+        self.max_size = max_size
+        self.values = np.empty(0)     # sorted distinct reference values (or sketch points)
+        self.cumcounts = np.empty(0)  # number of reference values <= values[i]
+        self.n = 0
+        self.exact = True
+        if values is not None:
+            self.add(values)
+
+    def add(self, values):
+        """
+        Merge new reference values into the index in place.
+
+        Returns:
+          ReferenceIndex: self.
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+
+        # Only the new values are sorted; the index already holds distinct sorted values
+        new_values, new_counts = np.unique(values, return_counts=True)
+        counts = np.diff(self.cumcounts, prepend=0.0)
+        merged, inverse = np.unique(np.concatenate([self.values, new_values]), return_inverse=True)
+        merged_counts = np.bincount(inverse, weights=np.concatenate([counts, new_counts]),
+                                    minlength=len(merged))
+        self.values = merged
+        self.cumcounts = np.cumsum(merged_counts)
+        self.n += len(values)
+
+        if self.max_size is not None and len(self.values) > self.max_size:
+            # Keep the points closest to max_size evenly spaced ranks
+            targets = np.linspace(0, self.n, self.max_size + 1)[1:]
+            keep = np.unique(np.searchsorted(self.cumcounts, targets, side='left'))
+            self.values = self.values[keep]
+            self.cumcounts = self.cumcounts[keep]
+            self.exact = False
+        return self
+
+    def merged(self, values):
+        """
+        Return a copy of the index with values added; the index itself is unchanged, so
+        earlier snapshots stay valid.
+        """
+        copy = ReferenceIndex(max_size=self.max_size)
+        copy.values, copy.cumcounts = self.values, self.cumcounts
+        copy.n, copy.exact = self.n, self.exact
+        return copy.add(values)
+
+    def count_le(self, x):
+        """
+        Number of reference values <= x, elementwise for an array of any shape.
+        """
+        i = np.searchsorted(self.values, x, side='right')
+        return np.where(i > 0, self.cumcounts[np.maximum(i - 1, 0)], 0.0)
+
+    def ecdf(self, x):
+        """
+        ECDF quantiles of x, counting all reference values <= x and dividing by (n+1) so that
+        quantiles of reference values are never exactly 0 or 1.
+        """
+        if self.n == 0:
+            raise ValueError("The reference index is empty")
+        return self.count_le(x) / (self.n + 1)
+
+    def gaussianize(self, x):
+        """
+        Map x to standard normal quantiles through the ECDF, elementwise for an array of any
+        shape. Values outside the reference range are clipped to its extreme quantiles and
+        NaN values stay NaN.
+        """
+        x = np.asarray(x, dtype=float)
+        q = np.clip(self.ecdf(x), 1.0 / (self.n + 1), self.n / (self.n + 1))
+        return np.where(np.isnan(x), np.nan, norm.ppf(q))
+
+    def gaussianize_many(self, arrays):
+        """
+        Gaussianize a list of arrays (e.g. one per user) in one batched call.
+
+        Returns:
+          list: The transformed arrays, in order.
+        """
+        if len(arrays) == 0:
+            return []
+        arrays = [np.asarray(a, dtype=float) for a in arrays]
+        flat = self.gaussianize(np.concatenate([a.ravel() for a in arrays]))
+        splits = np.cumsum([a.size for a in arrays])[:-1]
+        return [part.reshape(a.shape) for part, a in zip(np.split(flat, splits), arrays)]
+
+    def gaussian_outcome(self, y1, y2):
+        """
+        Gaussianized difference outcome gaussianize(y2) - gaussianize(y1). y1 and y2 may hold
+        the before/after values of many users at once, e.g. as (users, N) arrays.
+        """
+        return self.gaussianize(y2) - self.gaussianize(y1)
@@ -3,40 +3,148 @@
 
 import numpy as np
 import json
+import time
+from scipy.stats import norm, qmc, multivariate_normal
 
-# MAIN FUNCTION
-def draw_posterior_theta(Y, X, D, n_draws=1000):
+from backend.posterior_summaries import probability_of_best
+
+# PRIOR PARAMETERS
+PRIOR_VAR_THETA = 3.0  # relatively vague prior on the treatment effects
+PRIOR_VAR_BETA = 3.0   # relatively vague prior on the covariate effects
+SIGMA2 = 1.0           # known outcome equation noise variance
+
+# TREATMENT ENCODING
+# Every observation receives exactly one treatment, so the treatments are passed as an integer
+# arm index (0-based, shape (N,)) rather than a dense one-hot matrix D. A one-hot (N, J) matrix
+# is still accepted everywhere and converted to arm indices.
+def treatment_arms(D, J=None):
     """
-    Draw samples from the marginal posterior of theta.
-    
+    Return the arm index of each observation and the number of treatments.
+
     Parameters:
-      Y : (N,) numpy array of outcomes.
-      X : (N, K) numpy array of covariates.
-      D : (N, J) numpy array of treatment indicators (one-hot encoded for J treatments).
-      n_draws : int, number of posterior draws to generate.
-    
+      D : (N,) integer arm index (0-based) or (N, J) one-hot treatment matrix.
+      J : int, number of treatments; required for an arm index.
+
     Returns:
-      samples : (n_draws, J) numpy array where each row is a draw from the posterior of theta.
+      arm : (N,) integer numpy array of arm indices.
+      J : int, number of treatments.
     """
+    D = np.asarray(D)
+    if D.ndim == 2:
+        return np.argmax(D, axis=1), D.shape[1]
+    if J is None:
+        raise ValueError("The number of treatments J is required with an arm index")
+    return D.astype(np.int64, copy=False), J
+
+def segment_sum(index, values, n_segments):
+    """
+    Sum values (N,) or rows of values (N, K) by segment index, giving (n_segments,) or
+    (n_segments, K).
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        return np.bincount(index, weights=values, minlength=n_segments)
+    return np.stack([np.bincount(index, weights=values[:, k], minlength=n_segments)
+                     for k in range(values.shape[1])], axis=1).reshape((n_segments, values.shape[1]))
+
+# SUFFICIENT STATISTICS
+# The model is fully conjugate, so the posterior only depends on the data through Z'Z and Z'Y
+# with Z = [D, X]. A posterior state holds these statistics and can be updated with new
+# observations (a rank-k update) without revisiting the user's history. With one treatment
+# per observation the treatment blocks of Z'Z and Z'Y are per-arm segment sums, so D is never
+# formed and the update costs O(N K^2).
+def init_posterior_state(J, K):
+    """
+    Create an empty posterior state (prior only).
+
+    Parameters:
+      J : int, number of treatments.
+      K : int, number of covariates.
+
+    Returns:
+      state : dict with the sufficient statistics 'ZtZ' (J+K, J+K), 'ZtY' (J+K,), the
+              number of observations 'n', and the dimensions 'J' and 'K'.
+    """
+    return {
+        'J': J,
+        'K': K,
+        'n': 0,
+        'ZtZ': np.zeros((J + K, J + K)),
+        'ZtY': np.zeros(J + K),
+    }
+
+def update_posterior_state(state, Y, X, D):
+    """
+    Add new observations to a posterior state in place.
+
+    Parameters:
+      state : dict, posterior state from init_posterior_state.
+      Y : (N,) numpy array of new outcomes.
+      X : (N, K) numpy array of new covariates.
+      D : (N,) arm index or (N, J) one-hot matrix of the new treatments, see treatment_arms.
+
+    Returns:
+      state : the updated posterior state.
+    """
+    J = state['J']
+    arm, _ = treatment_arms(D, J)
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+
+    # Treatment blocks: D'D is diagonal with the arm counts, D'X and D'Y are per-arm sums
+    X_by_arm = segment_sum(arm, X, J)  # (J, K)
+    state['ZtZ'][:J, :J] += np.diag(np.bincount(arm, minlength=J).astype(float))
+    state['ZtZ'][:J, J:] += X_by_arm
+    state['ZtZ'][J:, :J] += X_by_arm.T
+    state['ZtZ'][J:, J:] += X.T @ X
+    state['ZtY'][:J] += segment_sum(arm, Y, J)
+    state['ZtY'][J:] += X.T @ Y
+    state['n'] += len(Y)
+    return state
+
+def serialize_posterior_state(state):
+    """
+    Convert a posterior state to a JSON-serializable dictionary.
+    """
+    return {
+        'J': state['J'],
+        'K': state['K'],
+        'n': state['n'],
+        'ZtZ': state['ZtZ'].tolist(),
+        'ZtY': state['ZtY'].tolist(),
+    }
+
+def deserialize_posterior_state(data):
+    """
+    Rebuild a posterior state from the output of serialize_posterior_state.
+    """
+    return {
+        'J': data['J'],
+        'K': data['K'],
+        'n': data['n'],
+        'ZtZ': np.array(data['ZtZ'], dtype=float),
+        'ZtY': np.array(data['ZtY'], dtype=float),
+    }
+
+def posterior_theta(state):
+    """
+    Compute the marginal posterior of theta from a posterior state.
+
+    Parameters:
+      state : dict, posterior state.
+
+    Returns:
+      mu_theta_post : (J,) posterior mean of theta.
+      Sigma_theta_post : (J, J) posterior covariance of theta.
+    """
+    J, K = state['J'], state['K']
 
-    # Dimensions
-    N = Y.shape[0]
-    K = X.shape[1]
-    J = D.shape[1]
-    
     # Define prior parameters
     mu_theta = np.zeros(J)
-    Sigma_theta = np.eye(J) * 3  # relatively vague prior
+    Sigma_theta = np.eye(J) * PRIOR_VAR_THETA
     mu_beta = np.zeros(K)
-    Sigma_beta = np.eye(K) * 3   # relatively vague prior
-    sigma2 = 1.0  # known outcome equation noise variance
+    Sigma_beta = np.eye(K) * PRIOR_VAR_BETA
 
-    # Ensure Y is a column vector
-    Y = Y.reshape(-1, 1)  # (N, 1)
-    
-    # Construct the full design matrix Z = [D, X]
-    Z = np.hstack([D, X])  # shape: (N, J+K)
-    
     # Compute the inverse of the prior covariance matrices
     inv_Sigma_theta = np.linalg.inv(Sigma_theta)  # (J, J)
     inv_Sigma_beta  = np.linalg.inv(Sigma_beta)     # (K, K)
@@ -48,7 +156,7 @@ def draw_posterior_theta(Y, X, D, n_draws=1000):
     ])  # shape: (J+K, J+K)
     
     # Data precision from the likelihood
-    data_precision = (Z.T @ Z) / sigma2  # (J+K, J+K)
+    data_precision = state['ZtZ'] / SIGMA2  # (J+K, J+K)
     
     # Posterior precision and covariance
     post_precision = data_precision + prior_precision  # (J+K, J+K)
@@ -56,24 +164,179 @@ def draw_posterior_theta(Y, X, D, n_draws=1000):
     
     # Compute posterior mean
     # First, form the combined prior mean vector [mu_theta; mu_beta]
-    prior_mean = np.concatenate([mu_theta, mu_beta]).reshape(-1, 1)  # (J+K, 1)
-    term = (Z.T @ Y) / sigma2 + prior_precision @ prior_mean  # (J+K, 1)
-    post_mean = post_cov @ term  # (J+K, 1)
+    prior_mean = np.concatenate([mu_theta, mu_beta])  # (J+K,)
+    term = state['ZtY'] / SIGMA2 + prior_precision @ prior_mean  # (J+K,)
+    post_mean = post_cov @ term  # (J+K,)
     
     # Extract the marginal posterior for theta (first J entries)
-    mu_theta_post = post_mean[:J].flatten()      # (J,)
+    mu_theta_post = post_mean[:J]                  # (J,)
     Sigma_theta_post = post_cov[:J, :J]            # (J, J)
-    
+    return mu_theta_post, Sigma_theta_post
+
+# PROBABILITY OF BEING THE BEST TREATMENT
+# Estimators of P(theta_j is the max) under theta ~ N(mu, Sigma):
+#   'mc'       - i.i.d. draws from np.random.multivariate_normal (SVD on every call)
+#   'cholesky' - i.i.d. draws as mu + L z with a single Cholesky factor L
+#   'qmc'      - scrambled Sobol points mapped through the Cholesky factor (lower variance)
+#   'exact'    - numerical integration: P(theta_j - theta_i > 0 for all i != j) is a
+#                (J-1)-dimensional Gaussian orthant probability, evaluated with scipy
+# n_draws is the accuracy/speed knob of the sampling methods and tol the one of 'exact'.
+BEST_ARM_METHODS = ('mc', 'cholesky', 'qmc', 'exact')
+
+def draw_gaussian(mu, Sigma, n_draws, method='cholesky', rng=None):
+    """
+    Draw samples from N(mu, Sigma).
+
+    Parameters:
+      mu : (J,) mean vector.
+      Sigma : (J, J) covariance matrix.
+      n_draws : int, number of draws.
+      method : str, 'mc', 'cholesky' or 'qmc' ('exact' draws as 'cholesky').
+      rng : optional numpy Generator (or seed) for the 'cholesky' and 'qmc' methods.
+
+    Returns:
+      samples : (n_draws, J) numpy array.
+    """
+    if method == 'mc':
+        return np.random.multivariate_normal(mu, Sigma, size=n_draws)
+    rng = np.random.default_rng(rng)
+    L = np.linalg.cholesky(Sigma)
+    if method == 'qmc':
+        # Sobol sequences are balanced for powers of two; draw the next one and truncate
+        m = int(np.ceil(np.log2(max(n_draws, 2))))
+        u = qmc.Sobol(d=len(mu), scramble=True, seed=rng).random_base2(m)[:n_draws]
+        z = norm.ppf(u)
+    else:
+        z = rng.standard_normal((n_draws, len(mu)))
+    return mu + z @ L.T
+
+def best_arm_probability_exact(mu, Sigma, tol=1e-4):
+    """
+    Compute P(theta_j is the max) for every j by numerical integration.
+
+    Parameters:
+      mu : (J,) mean vector.
+      Sigma : (J, J) covariance matrix.
+      tol : float, absolute error tolerance of the Gaussian orthant probabilities.
+
+    Returns:
+      posterior_best : (J,) numpy array summing to one.
+    """
+    J = len(mu)
+    if J == 1:
+        return np.ones(1)
+    posterior_best = np.empty(J)
+    for j in range(J):
+        # A theta = (theta_j - theta_i)_{i != j}; P(A theta > 0) = P(-A theta <= 0)
+        A = -np.eye(J)[np.arange(J) != j]
+        A[:, j] = 1.0
+        mean = A @ mu
+        cov = A @ Sigma @ A.T
+        if J == 2:
+            posterior_best[j] = norm.cdf(mean[0] / np.sqrt(cov[0, 0]))
+        else:
+            posterior_best[j] = multivariate_normal.cdf(
+                np.zeros(J - 1), mean=-mean, cov=cov, abseps=tol, releps=tol
+            )
+    posterior_best = np.clip(posterior_best, 0, None)
+    return posterior_best / posterior_best.sum()
+
+def best_arm_probability(samples):
+    """
+    Fraction of draws in which each treatment has the largest effect.
+
+    Parameters:
+      samples : (n_draws, J) numpy array of draws.
+
+    Returns:
+      posterior_best : (J,) numpy array; always of length J, also for arms that never win.
+    """
+    return probability_of_best(samples)
+
+def compare_best_estimators(mu, Sigma, n_draws=1200, methods=BEST_ARM_METHODS, reference_draws=200000,
+                            tol=1e-4, seed=0):
+    """
+    Compare the probability-of-best estimators against a large Monte Carlo reference.
+
+    Parameters:
+      mu : (J,) mean vector.
+      Sigma : (J, J) covariance matrix.
+      n_draws : int, number of draws for the sampling methods.
+      methods : iterable of method names to compare.
+      reference_draws : int, number of draws of the Monte Carlo reference.
+      tol : float, tolerance of the 'exact' method.
+      seed : int, random seed.
+
+    Returns:
+      dict: For each method, the seconds taken and the max absolute error against the reference.
+    """
+    np.random.seed(seed)
+    reference = best_arm_probability(np.random.multivariate_normal(mu, Sigma, size=reference_draws))
+    results = {}
+    for method in methods:
+        start = time.perf_counter()
+        if method == 'exact':
+            estimate = best_arm_probability_exact(mu, Sigma, tol=tol)
+        else:
+            estimate = best_arm_probability(draw_gaussian(mu, Sigma, n_draws, method=method, rng=seed))
+        results[method] = {
+            'seconds': time.perf_counter() - start,
+            'max_abs_error': float(np.max(np.abs(estimate - reference))),
+        }
+    return results
+
+def draw_posterior_theta_from_state(state, n_draws=1000, method='cholesky', tol=1e-4):
+    """
+    Draw samples from the marginal posterior of theta given a posterior state.
+
+    Parameters:
+      state : dict, posterior state.
+      n_draws : int, number of posterior draws to generate.
+      method : str, probability-of-best estimator, one of BEST_ARM_METHODS.
+      tol : float, error tolerance of the 'exact' estimator.
+
+    Returns:
+      samples : (n_draws, J) numpy array where each row is a draw from the posterior of theta.
+      posterior_best : (J,) numpy array, the posterior probability of each treatment being the best.
+    """
+    if method not in BEST_ARM_METHODS:
+        raise ValueError(f"Unknown method '{method}', expected one of {BEST_ARM_METHODS}")
+    mu_theta_post, Sigma_theta_post = posterior_theta(state)
+
     # Draw samples from N(mu_theta_post, Sigma_theta_post)
-    samples = np.random.multivariate_normal(mu_theta_post, Sigma_theta_post, size=n_draws)
+    samples = draw_gaussian(mu_theta_post, Sigma_theta_post, n_draws, method=method)
 
     # obtain the posterior likelihood of being the best treatment
-    best_arm = np.argmax(samples, axis=1)
-    counts = np.bincount(best_arm)
-    posterior_best = counts / n_draws
+    if method == 'exact':
+        posterior_best = best_arm_probability_exact(mu_theta_post, Sigma_theta_post, tol=tol)
+    else:
+        posterior_best = best_arm_probability(samples)
 
     return samples, posterior_best
 
+# MAIN FUNCTION
+def draw_posterior_theta(Y, X, D, n_draws=1000, method='cholesky', tol=1e-4, J=None):
+    """
+    Draw samples from the marginal posterior of theta.
+    
+    Parameters:
+      Y : (N,) numpy array of outcomes.
+      X : (N, K) numpy array of covariates.
+      D : (N,) arm index or (N, J) one-hot matrix of the treatments, see treatment_arms.
+      n_draws : int, number of posterior draws to generate.
+      method : str, probability-of-best estimator, one of BEST_ARM_METHODS.
+      tol : float, error tolerance of the 'exact' estimator.
+      J : int, number of treatments; required when D is an arm index.
+    
+    Returns:
+      samples : (n_draws, J) numpy array where each row is a draw from the posterior of theta.
+      posterior_best : (J,) numpy array, the posterior probability of each treatment being the best.
+    """
+    arm, J = treatment_arms(D, J)
+    state = init_posterior_state(J, X.shape[1])
+    update_posterior_state(state, Y, X, arm)
+    return draw_posterior_theta_from_state(state, n_draws=n_draws, method=method, tol=tol)
+
 
 
 # # Example usage (with made-up parameters):
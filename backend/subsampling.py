@@ -0,0 +1,297 @@
+## SUBSAMPLED HIERARCHICAL FITS FOR LARGE POPULATIONS
+## The cost of a hierarchical fit grows with the number of users, but the population
+## hyperparameters (mu, sigma of [theta; beta]) are pinned down well by a few hundred users.
+## Above a budget of TONEDOWN_MAX_USERS users the model is therefore fitted in two stages:
+##   1. select at most max_users peers (stratified over the population, or the users most
+##      similar to a requesting user) and fit the full model on them, keeping the draws of
+##      the hyperparameters;
+##   2. draw every other user's coefficients from their closed-form conditional posterior
+##      w_m | mu, sigma, data, one draw per hyperparameter draw, from their sufficient
+##      statistics. This is the user step of the Gibbs sampler with the population fixed,
+##      so the other users inform the population only through the subsample. It runs when a
+##      user's draws or probabilities are first read, so the cost of a fit does not grow
+##      with the population beyond the users that are actually served.
+## compare_subsampling in benchmark.py measures the difference to the full fit.
+
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from backend.gibbs_sampler import user_sufficient_statistics
+from backend.hierarchical_sampler import prepare_hierarchical_data, run_hierarchical_model
+from backend.metrics import span
+from backend.posterior_summaries import probability_of_best
+from backend.single_user_sampler import treatment_arms
+
+# Largest number of users fitted jointly; 0 disables subsampling
+MAX_USERS = int(os.environ.get('TONEDOWN_MAX_USERS', '0'))
+SUBSAMPLE_STRATEGIES = ('stratified', 'similarity')
+# Peer selection of per-request fits; population fits have no anchor user and are stratified
+SUBSAMPLE_STRATEGY = os.environ.get('TONEDOWN_SUBSAMPLE_STRATEGY', 'stratified')
+# Number of observation-count strata of the stratified selection
+COUNT_STRATA = 4
+# Values of the batched (users, draws, P, P) precision matrices computed at once
+CONDITIONAL_CHUNK_ELEMENTS = 1 << 22
+
+def subsampling_enabled(n_users, max_users=MAX_USERS):
+    """
+    Whether a population of n_users is fitted on a subsample.
+    """
+    return 0 < max_users < n_users
+
+# AUXILIARY FUNCTION
+def user_summaries(user_data, J=None):
+    """
+    Summarize each user's data for peer selection.
+
+    Parameters:
+      user_data (list): List of tuples (Y, X, D), see prepare_hierarchical_data.
+      J (int): Number of treatments; required when D holds arm indices.
+
+    Returns:
+      dict: 'n' (M,) observation counts, 'arm_counts' (M, J) and 'arm_means' (M, J) mean
+            outcome per arm (the user's mean outcome where an arm is unused, the population
+            mean for users without data).
+    """
+    M = len(user_data)
+    _, J = treatment_arms(user_data[0][2], J)
+    n = np.fromiter((len(Y) for Y, _, _ in user_data), dtype=np.int64, count=M)
+    user = np.repeat(np.arange(M), n)
+    Y = np.concatenate([np.asarray(Y, dtype=float) for Y, _, _ in user_data])
+    arm = np.concatenate([treatment_arms(D, J)[0] for _, _, D in user_data])
+
+    cell = user * J + arm
+    arm_counts = np.bincount(cell, minlength=M * J).reshape(M, J)
+    arm_sums = np.bincount(cell, weights=Y, minlength=M * J).reshape(M, J)
+    overall = Y.mean() if len(Y) else 0.0
+    user_means = np.where(n > 0, arm_sums.sum(axis=1) / np.maximum(n, 1), overall)
+    arm_means = np.where(arm_counts > 0, arm_sums / np.maximum(arm_counts, 1), user_means[:, None])
+    return {'n': n, 'arm_counts': arm_counts, 'arm_means': arm_means}
+
+def _stratified(summaries, candidates, budget, rng):
+    # Proportional allocation over (observation-count quantile, most used arm) strata
+    n = summaries['n'][candidates]
+    edges = np.quantile(n, np.linspace(0, 1, COUNT_STRATA + 1)[1:-1])
+    top_arm = np.argmax(summaries['arm_counts'][candidates], axis=1)
+    strata = np.searchsorted(edges, n, side='right') * summaries['arm_counts'].shape[1] + top_arm
+
+    _, inverse, sizes = np.unique(strata, return_inverse=True, return_counts=True)
+    quota = budget * sizes / len(candidates)
+    allocation = np.floor(quota).astype(np.int64)
+    # Hand out the remaining places by largest remainder
+    allocation[np.argsort(allocation - quota)[:budget - allocation.sum()]] += 1
+    chosen = [rng.choice(candidates[inverse == s], size=k, replace=False)
+              for s, k in enumerate(allocation) if k > 0]
+    return np.concatenate(chosen) if chosen else np.empty(0, dtype=np.int64)
+
+def _similar(summaries, candidates, anchor, budget):
+    # Nearest users by standardized per-arm means, arm shares and log observation count
+    shares = summaries['arm_counts'] / np.maximum(summaries['n'], 1)[:, None]
+    features = np.hstack([summaries['arm_means'], shares, np.log1p(summaries['n'])[:, None]])
+    scale = features.std(axis=0)
+    features = features / np.where(scale > 0, scale, 1.0)
+    distance = ((features[candidates] - features[anchor]) ** 2).sum(axis=1)
+    return candidates[np.argsort(distance, kind='stable')[:budget]]
+
+def select_peers(user_data, max_users=MAX_USERS, strategy=SUBSAMPLE_STRATEGY, anchor=None,
+                 J=None, seed=None):
+    """
+    Select the users the hierarchical model is fitted on.
+
+    Parameters:
+      user_data (list): List of tuples (Y, X, D), see prepare_hierarchical_data.
+      max_users (int): Number of users to select.
+      strategy (str): 'stratified' samples proportionally from strata of observation count
+                      and most used arm; 'similarity' takes the users closest to the anchor
+                      in per-arm mean outcome and arm usage (stratified without an anchor).
+      anchor (int): Optional row of a user that is always selected, e.g. the requesting user.
+      J (int): Number of treatments; required when D holds arm indices.
+      seed (int): Random seed of the stratified selection.
+
+    Returns:
+      np.ndarray: Sorted rows of the selected users (all rows if there are at most max_users).
+    """
+    if strategy not in SUBSAMPLE_STRATEGIES:
+        raise ValueError(f"Unknown subsampling strategy '{strategy}', expected one of {SUBSAMPLE_STRATEGIES}")
+    M = len(user_data)
+    if not subsampling_enabled(M, max_users):
+        return np.arange(M)
+
+    summaries = user_summaries(user_data, J)
+    candidates = np.arange(M)
+    budget = max_users
+    if anchor is not None:
+        anchor = anchor % M
+        candidates = candidates[candidates != anchor]
+        budget -= 1
+
+    if strategy == 'similarity' and anchor is not None:
+        rows = _similar(summaries, candidates, anchor, budget)
+    else:
+        rows = _stratified(summaries, candidates, budget, np.random.default_rng(seed))
+    if anchor is not None:
+        rows = np.append(rows, anchor)
+    return np.sort(rows)
+
+def conditional_theta_draws(user_data, hyper_draws, sigma=1.0, J=None, rng=None):
+    """
+    Draw users' treatment effects from their conditional posterior given population draws.
+
+    For every hyperparameter draw s, w_m ~ N(prec^-1 (Z'Y/sigma^2 + mu_s/s2_s), prec^-1) with
+    prec = Z'Z/sigma^2 + diag(1/s2_s), batched over users and draws.
+
+    Parameters:
+      user_data (list): List of tuples (Y, X, D) of the users, see prepare_hierarchical_data.
+      hyper_draws (dict): 'mu' and 's2' draws (n_draws, J+K), see sample_theta.
+      sigma (float): Known noise standard deviation.
+      J (int): Number of treatments; required when D holds arm indices.
+      rng (np.random.Generator): Random generator.
+
+    Returns:
+      np.ndarray: (n_draws, M, J) draws of theta.
+    """
+    rng = rng or np.random.default_rng()
+    data = prepare_hierarchical_data(user_data, sigma=sigma, J=J)
+    M, J = data['M'], data['J']
+    ZtZ, ZtY, _ = user_sufficient_statistics(data)
+    sigma2 = float(sigma) ** 2
+    mu, s2 = hyper_draws['mu'], hyper_draws['s2']
+    n_draws, P = mu.shape
+    diag = np.arange(P)
+
+    theta_draws = np.empty((n_draws, M, J))
+    users_per_chunk = max(1, CONDITIONAL_CHUNK_ELEMENTS // (n_draws * P * P))
+    for start in range(0, M, users_per_chunk):
+        stop = min(start + users_per_chunk, M)
+        precision = np.repeat((ZtZ[start:stop] / sigma2)[:, None], n_draws, axis=1)
+        precision[:, :, diag, diag] += 1.0 / s2  # (users, n_draws, P, P)
+        rhs = (ZtY[start:stop] / sigma2)[:, None, :] + mu / s2
+        L = np.linalg.cholesky(precision)
+        mean = np.linalg.solve(precision, rhs[..., None])[..., 0]
+        z = rng.standard_normal(rhs.shape + (1,))
+        w = mean + np.linalg.solve(np.swapaxes(L, -1, -2), z)[..., 0]
+        theta_draws[:, start:stop] = np.swapaxes(w[:, :, :J], 0, 1)
+    return theta_draws
+
+class SubsampledFit:
+    """
+    Hierarchical fit of a subsample whose other users are drawn conditionally on demand.
+
+    Only the subsample's draws are kept. The draws of any other user are computed when they
+    are read, so keeping the fit costs the same for any population size; best-arm
+    probabilities are computed the first time a user is read and remembered.
+
+    Attributes:
+      fit_id (str): Random id of the fit.
+      rows (np.ndarray): Sorted rows of the fitted subsample.
+      n_draws, M, J (int): Shape of the population's theta draws.
+      hyper_draws (dict): Population draws of the subsample fit (empty if it failed).
+    """
+
+    def __init__(self, user_data, rows, theta_draws, proportions, hyper_draws, sigma=1.0,
+                 seed=None):
+        self.fit_id = uuid.uuid4().hex
+        self.user_data = user_data
+        self.rows = rows
+        self.n_draws, _, self.J = theta_draws.shape
+        self.M = len(user_data)
+        self.hyper_draws = hyper_draws
+        self.sigma = sigma
+        self._theta_draws = theta_draws  # (n_draws, len(rows), J)
+        self._position = {int(m): i for i, m in enumerate(rows)}
+        self._proportions = np.full((self.M, self.J), np.nan)
+        self._proportions[rows] = proportions
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def _draws(self, members):
+        # (n_draws, len(members), J) draws of the given rows
+        theta_draws = np.empty((self.n_draws, len(members), self.J))
+        fitted = np.array([m in self._position for m in members], dtype=bool)
+        if fitted.any():
+            theta_draws[:, fitted] = self._theta_draws[:, [self._position[m] for m in members[fitted]]]
+        if not fitted.all():
+            others = [self.user_data[m] for m in members[~fitted]]
+            if self.hyper_draws:
+                theta_draws[:, ~fitted] = conditional_theta_draws(
+                    others, self.hyper_draws, sigma=self.sigma, J=self.J, rng=self._rng
+                )
+            else:
+                # The subsample fit failed; fall back like run_hierarchical_model
+                theta_draws[:, ~fitted] = self._rng.normal(0, 1, (self.n_draws, len(others), self.J))
+        return theta_draws
+
+    def _remember(self, members, theta_draws):
+        # Store the best-arm probabilities of rows that have none yet
+        proportions = (probability_of_best(theta_draws) if self.hyper_draws
+                       else np.full((len(members), self.J), 1.0 / self.J))
+        with self._lock:
+            new = np.isnan(self._proportions[members, 0])
+            self._proportions[members[new]] = proportions[new]
+
+    def user_draws(self, m):
+        """
+        Return the (n_draws, J) draws of the user in row m, drawn now if m is not in the subsample.
+        """
+        members = np.array([m % self.M])
+        theta_draws = self._draws(members)
+        self._remember(members, theta_draws)
+        return theta_draws[:, 0]
+
+    def user_proportions(self, rows, users_per_block=256):
+        """
+        Return the (len(rows), J) best-arm probabilities of the given rows, drawing the
+        users seen for the first time in blocks.
+        """
+        rows = np.asarray(rows, dtype=np.int64) % self.M
+        with self._lock:
+            missing = np.unique(rows[np.isnan(self._proportions[rows, 0])])
+        for start in range(0, len(missing), users_per_block):
+            members = missing[start:start + users_per_block]
+            self._remember(members, self._draws(members))
+        with self._lock:
+            return self._proportions[rows].copy()
+
+# MAIN ENTRY POINT
+def fit_subsampled_hierarchical_model(user_data, max_users=MAX_USERS, strategy=SUBSAMPLE_STRATEGY,
+                                      anchor=None, seed=None, sigma=1.0, J=None,
+                                      diagnostics=None, **kwargs):
+    """
+    Fit the hierarchical model on at most max_users peers; the other users are drawn from
+    their conditional posterior given the fitted population (see SubsampledFit).
+
+    Parameters:
+      user_data (list): List of tuples (Y, X, D), see prepare_hierarchical_data.
+      max_users (int): User budget of the joint fit, see select_peers.
+      strategy (str): Peer selection, see select_peers.
+      anchor (int): Optional row of a user that is always part of the joint fit.
+      seed (int): Random seed of the selection and the conditional draws.
+      sigma (float): Known noise standard deviation.
+      J (int): Number of treatments; required when D holds arm indices.
+      diagnostics (dict): Optional dictionary that is filled as by run_hierarchical_model,
+                          plus 'subsample_users', 'subsample_strategy' and 'selection_seconds'.
+      **kwargs: Passed on to run_hierarchical_model.
+
+    Returns:
+      SubsampledFit: The fit.
+    """
+    if diagnostics is None:
+        diagnostics = {}
+    start = time.perf_counter()
+    with span('peer_selection'):
+        rows = select_peers(user_data, max_users=max_users, strategy=strategy, anchor=anchor,
+                            J=J, seed=seed)
+    diagnostics['selection_seconds'] = time.perf_counter() - start
+    diagnostics['subsample_users'] = len(rows)
+    diagnostics['subsample_strategy'] = strategy
+
+    hyper_draws = {}
+    theta_draws, proportions = run_hierarchical_model(
+        [user_data[m] for m in rows], sigma=sigma, J=J, diagnostics=diagnostics,
+        hyper_draws=hyper_draws, **kwargs
+    )
+    return SubsampledFit(user_data, rows, theta_draws, proportions, hyper_draws, sigma=sigma,
+                         seed=seed)
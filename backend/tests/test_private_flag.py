@@ -0,0 +1,40 @@
+## TESTS OF THE PRIVACY FLAG OF UPLOADED DATA
+## Run from the repository root: python -m pytest backend/tests
+
+import numpy as np
+import pandas as pd
+
+from backend.backend_wrapper import (
+    dump_user_posterior_state, extract_all_user_data, load_user_posterior_state,
+    update_user_posterior_state
+)
+from flask_backend import storage
+
+def _update_state(state, rows):
+    # The state_update the upload route passes to append_records
+    user_state = None if state is None else load_user_posterior_state(state)
+    return dump_user_posterior_state(update_user_posterior_state(user_state, rows))
+
+def _upload(db_path, uid, timestamps, is_private):
+    rows = pd.DataFrame({
+        'uid': uid,
+        'timestamp': timestamps,
+        'tinnitus-initial': np.arange(len(timestamps), dtype=float),
+        'stress': 0.0, 'sleep': 0.0, 'noise': 0.0,
+        'location': 'Home',
+        'is_private': pd.array(is_private, dtype='string'),
+    })
+    storage.append_records(db_path, rows, storage.SOURCE_REGULAR, state_update=_update_state)
+
+def test_null_is_private_keeps_the_last_known_setting(tmp_path):
+    db_path = storage.init_store(str(tmp_path))
+    _upload(db_path, 'private', ['2024-01-01', '2024-01-02'], ['true', None])
+    _upload(db_path, 'private', ['2024-01-03'], [None])
+    _upload(db_path, 'unknown', ['2024-01-01'], [None])
+
+    database_pull, _ = storage.load_database_pull(db_path)
+    user_index = extract_all_user_data(database_pull)
+    for uid, expected in [('private', True), ('unknown', False)]:
+        user_state = load_user_posterior_state(storage.load_state(db_path, uid))
+        assert user_index[uid][0] == expected
+        assert user_state['is_private'] == expected
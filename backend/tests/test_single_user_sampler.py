@@ -0,0 +1,69 @@
+## TESTS OF THE SINGLE-USER SAMPLER
+## Run from the repository root: python -m pytest backend/tests
+
+import numpy as np
+import pytest
+
+from backend.single_user_sampler import (
+    PRIOR_VAR_BETA, PRIOR_VAR_THETA, SIGMA2, best_arm_probability, compare_best_estimators,
+    deserialize_posterior_state, draw_posterior_theta, init_posterior_state, posterior_theta,
+    serialize_posterior_state, update_posterior_state
+)
+
+MU = np.array([0.3, 0.1, 0.0, -0.2])
+SIGMA = np.array([
+    [0.20, 0.05, 0.02, 0.00],
+    [0.05, 0.15, 0.03, 0.01],
+    [0.02, 0.03, 0.25, 0.04],
+    [0.00, 0.01, 0.04, 0.10],
+])
+
+def _user_data(n, J=3, K=2, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, K))
+    arm = rng.integers(0, J, n)
+    Y = rng.normal(size=J)[arm] + X @ rng.normal(size=K) + rng.normal(size=n)
+    return Y, X, arm
+
+@pytest.mark.parametrize('method', ['cholesky', 'qmc', 'exact'])
+def test_estimators_match_monte_carlo_reference(method):
+    result = compare_best_estimators(MU, SIGMA, n_draws=20000, methods=[method],
+                                     reference_draws=400000, seed=1)
+    assert result[method]['max_abs_error'] < 0.02
+
+def test_best_arm_probability_has_length_J_when_arms_never_win():
+    samples = np.random.default_rng(0).normal([5.0, -5.0, -5.0, -5.0], 0.1, size=(500, 4))
+    posterior_best = best_arm_probability(samples)
+    assert posterior_best.shape == (4,)
+    np.testing.assert_allclose(posterior_best, [1.0, 0.0, 0.0, 0.0])
+
+def test_draw_posterior_theta_returns_all_arms():
+    # Only arm 0 is ever used, but all J=6 arms are reported
+    Y, X, _ = _user_data(30)
+    samples, posterior_best = draw_posterior_theta(Y, X, np.zeros(30, dtype=int), n_draws=200, J=6)
+    assert samples.shape == (200, 6)
+    assert posterior_best.shape == (6,)
+    assert posterior_best.sum() == pytest.approx(1.0)
+
+def test_incremental_state_matches_closed_form():
+    J, K = 3, 2
+    Y, X, arm = _user_data(50, J, K)
+
+    # Rank-k updates over batches, with a serialization round trip in between
+    state = init_posterior_state(J, K)
+    for batch in np.array_split(np.arange(50), [1, 7, 30]):
+        state = update_posterior_state(state, Y[batch], X[batch], arm[batch])
+        state = deserialize_posterior_state(serialize_posterior_state(state))
+    assert state['n'] == 50
+
+    # Closed form from the full history with the one-hot design Z = [D, X]
+    Z = np.hstack([np.eye(J)[arm], X])
+    prior_precision = np.diag([1 / PRIOR_VAR_THETA] * J + [1 / PRIOR_VAR_BETA] * K)
+    post_cov = np.linalg.inv(Z.T @ Z / SIGMA2 + prior_precision)
+    post_mean = post_cov @ (Z.T @ Y / SIGMA2)
+
+    np.testing.assert_allclose(state['ZtZ'], Z.T @ Z)
+    np.testing.assert_allclose(state['ZtY'], Z.T @ Y)
+    mu_theta, Sigma_theta = posterior_theta(state)
+    np.testing.assert_allclose(mu_theta, post_mean[:J])
+    np.testing.assert_allclose(Sigma_theta, post_cov[:J, :J])
@@ -1,76 +1,180 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import os
-import pandas as pd
 from flask_cors import CORS
 from io import StringIO
 import datetime
 import sys
+import cProfile
+import functools
+import time
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from backend.backend_wrapper import backend_call
+from backend.backend_wrapper import (
+    update_user_posterior_state, dump_user_posterior_state, load_user_posterior_state
+)
+from backend.cpu_budget import CPU_BUDGET
+from backend.hierarchical_sampler import INFERENCE_BACKEND, model_is_loaded, warm_up_model
+from backend.metrics import clear_metrics_dir, span, render_prometheus
+from flask_backend import storage
+from flask_backend.jobs import AnalysisJobQueue, run_analysis, run_batch_analysis
+from flask_backend.ingest import iter_record_batches, SchemaError
+from flask_backend.recommendations import RecommendationScheduler
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Create a directory to store uploaded CSV files
+# Directory of the store and any legacy uploaded CSV files
 UPLOAD_DIR = 'uploads'
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Longest a poll request may wait for a job to finish
+MAX_JOB_WAIT_SECONDS = 30
+
+# Process state set up by create_app. Importing this module has no side effects: the job pool
+# workers re-import the main module, and must not open the store or start a scheduler.
+DB_PATH = None
+MODEL_READY = False
+JOB_QUEUE = None
+RECOMMENDATION_SCHEDULER = None
+
+def create_app():
+    """
+    Set up the store, model, dataset cache, job queue and recommendation scheduler of this
+    process (once) and return the app. Called by the development server and by wsgi.py.
+    """
+    global DB_PATH, MODEL_READY, JOB_QUEUE, RECOMMENDATION_SCHEDULER
+    if DB_PATH is not None:
+        return app
+
+    # Uploaded records live in an append-only SQLite store inside the upload directory
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    db_path = storage.init_store(UPLOAD_DIR)
+
+    # Compile or load the hierarchical Stan model once, before the app starts serving requests
+    MODEL_READY = warm_up_model()
+
+    # Load the merged dataset into this process's cache before the first analysis request
+    storage.load_database_pull(db_path)
+
+    # Background analysis jobs, run by a local process pool
+    JOB_QUEUE = AnalysisJobQueue(db_path)
+
+    # Rankings are precomputed in the background and served as snapshots by /api/get-analysis
+    RECOMMENDATION_SCHEDULER = RecommendationScheduler(db_path)
+    if os.environ.get('TONEDOWN_PRECOMPUTE', '1') == '1':
+        RECOMMENDATION_SCHEDULER.start()
+
+    DB_PATH = db_path
+    return app
+
+# Per-request cProfile dumps, enabled for every request with TONEDOWN_PROFILE=1 or for a single
+# request with the X-Profile: 1 header
+PROFILE_ALL_REQUESTS = os.environ.get('TONEDOWN_PROFILE', '0') == '1'
+PROFILE_DIR = os.environ.get('TONEDOWN_PROFILE_DIR', 'profiles')
+
+def instrumented(stage):
+    """
+    Record the duration of an endpoint under `stage` and optionally profile the request.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not (PROFILE_ALL_REQUESTS or request.headers.get('X-Profile') == '1'):
+                with span(stage):
+                    return view(*args, **kwargs)
+
+            profiler = cProfile.Profile()
+            with span(stage):
+                result = profiler.runcall(view, *args, **kwargs)
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile_path = os.path.join(PROFILE_DIR, f"{stage}_{time.time_ns()}.prof")
+            profiler.dump_stats(profile_path)
+            print(f"Wrote profile to {profile_path}")
+            return result
+        return wrapper
+    return decorator
+
+def update_posterior_state(state, rows):
+    """
+    Maintain the stored posterior state of a user while their rows are appended.
+    """
+    user_state = None if state is None else load_user_posterior_state(state)
+    return dump_user_posterior_state(update_user_posterior_state(user_state, rows))
 
 @app.route('/api/upload-csv', methods=['POST'])
+@instrumented('request_upload_csv')
 def upload_csv():
+    rows_written = 0
     try:
-        # Check if the request contains CSV data
-        if 'csv_data' not in request.json:
-            return jsonify({'error': 'No CSV data provided'}), 400
-        
-        csv_data = request.json['csv_data']
-        user_id = request.json.get('user_id', 'unknown')
-        with_feedback = request.json.get('with_feedback', False)
-        
-        # Create a unique filename based on whether it includes feedback
-        if with_feedback:
-            filename = "tinnitus_data_feedback.csv"
-        else:
-            filename = "tinnitus_data.csv"
+        if request.is_json:
+            # Check if the request contains CSV data
+            if 'csv_data' not in request.json:
+                return jsonify({'error': 'No CSV data provided'}), 400
             
-        filepath = os.path.join(UPLOAD_DIR, filename)
+            csv_data = request.json['csv_data']
+            user_id = request.json.get('user_id', 'unknown')
+            with_feedback = request.json.get('with_feedback', False)
+            stream, content_type = StringIO(csv_data), 'text/csv'
+        else:
+            # Raw CSV or NDJSON body (bulk backfills), parsed while it streams in
+            user_id = request.args.get('user_id', 'unknown')
+            with_feedback = request.args.get('with_feedback', 'false').lower() in ('1', 'true', 'yes')
+            stream, content_type = request.stream, request.content_type
         
-        # Parse the CSV string into a pandas DataFrame
-        new_df = pd.read_csv(StringIO(csv_data))
+        # Records with feedback are tagged as such in the store
+        source = storage.SOURCE_FEEDBACK if with_feedback else storage.SOURCE_REGULAR
         
-        # Check if file already exists
-        if os.path.exists(filepath):
-            # Read existing data
-            existing_df = pd.read_csv(filepath)
-            # Append new data to existing data
-            combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-        else:
-            # If file doesn't exist, use only the new data
-            combined_df = new_df
+        # Parse and validate the body in chunks; every chunk is appended as one batch, so the
+        # cost does not depend on the stored history and memory stays bounded by the chunk size.
+        # Appends also keep each user's private-mode posterior state up to date.
+        batches = iter_record_batches(stream, content_type)
+        record_count = storage.get_record_count(DB_PATH, source)
+        columns = []
+        while True:
+            with span('csv_parse'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            with span('storage_append'):
+                _, record_count = storage.append_records(
+                    DB_PATH, batch, source, state_update=update_posterior_state
+                )
+            rows_written += len(batch)
+            columns = batch.columns.tolist()
         
-        # Save the combined DataFrame to a CSV file
-        combined_df.to_csv(filepath, index=False)
+        # New feedback changes the rankings; refresh the precomputed ones soon
+        if with_feedback and rows_written > 0:
+            RECOMMENDATION_SCHEDULER.notify()
         
         # Optional: Print summary statistics
         print(f"Received data for user {user_id} with feedback={with_feedback}:")
-        print(f"Shape: {new_df.shape}")
-        print(f"Columns: {new_df.columns.tolist()}")
-        print(f"Total records in file: {len(combined_df)}")
+        print(f"Rows: {rows_written}")
+        print(f"Columns: {columns}")
+        print(f"Total records in store: {record_count}")
         
         return jsonify({
             'success': True,
             'message': 'CSV data received and saved successfully',
-            'filename': filename,
-            'record_count': len(combined_df),
+            'filename': storage.LEGACY_FILES[source],
+            'rows_written': rows_written,
+            'record_count': record_count,
             'with_feedback': with_feedback
         }), 200
         
+    except SchemaError as e:
+        # Batches before the invalid one have already been stored
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'rows_written': rows_written
+        }), 400
+
     except Exception as e:
         return jsonify({
             'success': False,
-            'error': str(e)
+            'error': str(e),
+            'rows_written': rows_written
         }), 500
 
 @app.route('/api/get-analysis', methods=['GET'])
+@instrumented('request_get_analysis')
 def get_analysis():
     try:
         # Get user_id from query parameters
@@ -84,46 +188,30 @@ def get_analysis():
 
         print(f"Processing analysis request for user: {user_id}")
 
-        # Read both regular and feedback data
-        regular_filepath = os.path.join(UPLOAD_DIR, "tinnitus_data.csv")
-        feedback_filepath = os.path.join(UPLOAD_DIR, "tinnitus_data_feedback.csv")
+        # Serve the latest precomputed snapshot unless a fresh computation is requested
+        fresh = request.args.get('fresh', 'false').lower() in ('1', 'true', 'yes')
+        snapshot = None if fresh else storage.load_recommendation(DB_PATH, user_id)
+        if snapshot is not None:
+            diagnosis_probabilities, revision, computed_at = snapshot
+            response = jsonify(diagnosis_probabilities)
+            response.headers['X-Recommendation-Age'] = f"{time.time() - computed_at:.1f}"
+            response.headers['X-Recommendation-Revision'] = str(revision)
+            print(f"Served precomputed analysis for user {user_id}")
+            return response, 200
 
-        if not os.path.exists(regular_filepath):
-            print(f"Error: No data file found at {regular_filepath}")
+        try:
+            diagnosis_probabilities = run_analysis(DB_PATH, user_id)
+        except LookupError as e:
+            print(f"Error: {str(e)}")
             return jsonify({
                 'error': 'No data available for analysis',
                 'message': 'Please upload data first'
             }), 404
-
-        # Read and combine the data
-        database_pull = pd.read_csv(regular_filepath)
-        if os.path.exists(feedback_filepath):
-            feedback_data = pd.read_csv(feedback_filepath)
-            # Ensure all columns exist in both dataframes
-            for col in database_pull.columns:
-                if col not in feedback_data.columns:
-                    feedback_data[col] = None
-            for col in feedback_data.columns:
-                if col not in database_pull.columns:
-                    database_pull[col] = None
-            
-            # Combine the data
-            database_pull = pd.concat([database_pull, feedback_data], ignore_index=True)
-            
-            # Sort by timestamp to ensure proper ordering
-            database_pull = database_pull.sort_values('timestamp')
-            
-            # Convert is_private to boolean, handling NaN values
-            database_pull['is_private'] = database_pull['is_private'].fillna(False)
-            database_pull['is_private'] = database_pull['is_private'].astype(bool)
-
-        print(f"Found {len(database_pull)} total records in database")
-
-        # Run the backend analysis
-        _, diagnosis_probabilities = backend_call(user_id, database_pull)
         print(f"Successfully generated analysis for user {user_id}")
         
-        return jsonify(diagnosis_probabilities), 200
+        response = jsonify(diagnosis_probabilities)
+        response.headers['X-Recommendation-Age'] = '0.0'
+        return response, 200
         
     except Exception as e:
         print(f"Error in get_analysis: {str(e)}")
@@ -132,5 +220,137 @@ def get_analysis():
             'message': str(e)
         }), 500
 
+@app.route('/api/get-analysis/batch', methods=['POST'])
+@instrumented('request_get_analysis_batch')
+def get_analysis_batch():
+    try:
+        # user_ids is a list of user ids or "all" for every shared user
+        body = request.get_json(silent=True) or {}
+        user_ids = body.get('user_ids')
+        if not (user_ids == 'all' or (isinstance(user_ids, list) and user_ids)):
+            return jsonify({
+                'error': 'No user_ids provided',
+                'message': 'Please provide user_ids as a list of user ids or "all"'
+            }), 400
+
+        try:
+            results, revision = run_batch_analysis(DB_PATH, user_ids)
+        except LookupError as e:
+            print(f"Error: {str(e)}")
+            return jsonify({
+                'error': 'No data available for analysis',
+                'message': 'Please upload data first'
+            }), 404
+        print(f"Successfully generated analysis for {len(results)} users")
+
+        missing = [] if user_ids == 'all' else [uid for uid in user_ids if uid not in results]
+        return jsonify({
+            'results': results,
+            'missing': missing,
+            'revision': revision
+        }), 200
+
+    except Exception as e:
+        print(f"Error in get_analysis_batch: {str(e)}")
+        return jsonify({
+            'error': 'Analysis error',
+            'message': str(e)
+        }), 500
+
+@app.route('/api/analysis-jobs', methods=['POST'])
+def submit_analysis_job():
+    try:
+        # Accept the user_id from the JSON body or the query parameters
+        body = request.get_json(silent=True) or {}
+        user_id = body.get('user_id') or request.args.get('user_id')
+        if not user_id:
+            return jsonify({
+                'error': 'No user_id provided',
+                'message': 'Please provide a user_id in the body or as a query parameter'
+            }), 400
+
+        # Identical requests for the same data revision share one job
+        job_id = JOB_QUEUE.submit(user_id)
+        print(f"Analysis job {job_id} for user {user_id}")
+
+        return jsonify({
+            'job_id': job_id,
+            'status_url': f"/api/analysis-jobs/{job_id}"
+        }), 202
+
+    except Exception as e:
+        print(f"Error in submit_analysis_job: {str(e)}")
+        return jsonify({
+            'error': 'Job submission error',
+            'message': str(e)
+        }), 500
+
+@app.route('/api/analysis-jobs/<job_id>', methods=['GET'])
+def get_analysis_job(job_id):
+    try:
+        # Optional long poll: wait up to `wait` seconds for the job to finish
+        wait = min(float(request.args.get('wait', 0)), MAX_JOB_WAIT_SECONDS)
+        status = JOB_QUEUE.status(job_id, wait=wait)
+        if status is None:
+            return jsonify({
+                'error': 'Unknown job',
+                'message': f"No job with id {job_id}"
+            }), 404
+
+        return jsonify(status), 200
+
+    except Exception as e:
+        print(f"Error in get_analysis_job: {str(e)}")
+        return jsonify({
+            'error': 'Job status error',
+            'message': str(e)
+        }), 500
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    # Liveness: the process is up and serving requests
+    return jsonify({'status': 'ok', 'pid': os.getpid()}), 200
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    # Readiness: the store is reachable, the model is compiled (unless the deployment does not
+    # use CmdStan) and this worker's dataset cache has been loaded
+    try:
+        revision = storage.get_revision(DB_PATH)
+        recommendations_revision = storage.get_recommendations_revision(DB_PATH)
+        database_ok = True
+    except Exception as e:
+        print(f"Error in ready: {str(e)}")
+        revision = recommendations_revision = None
+        database_ok = False
+
+    model_compiled = model_is_loaded()
+    model_required = INFERENCE_BACKEND != 'gibbs'
+    cache_revision = storage.get_dataset_cache(DB_PATH).revision
+    cache_warm = cache_revision is not None
+    is_ready = database_ok and cache_warm and (model_compiled or not model_required)
+
+    return jsonify({
+        'ready': is_ready,
+        'pid': os.getpid(),
+        'database': database_ok,
+        'model_compiled': model_compiled,
+        'inference_backend': INFERENCE_BACKEND,
+        'cache_warm': cache_warm,
+        'revision': revision,
+        'cache_revision': cache_revision,
+        'recommendations_revision': recommendations_revision,
+        'scheduler_leader': RECOMMENDATION_SCHEDULER.is_leader,
+        'cpu': CPU_BUDGET.usage(),
+    }), 200 if is_ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Stage timings of all processes in the Prometheus text format
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Development server; in production serve wsgi:app with gunicorn (see gunicorn.conf.py).
+    # The reloader would run the startup a second time in its watcher process.
+    clear_metrics_dir()
+    create_app().run(debug=True, host='0.0.0.0', port=5000, use_reloader=False)
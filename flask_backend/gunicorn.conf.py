@@ -0,0 +1,32 @@
+## GUNICORN CONFIGURATION
+## Usage (from the flask_backend directory):
+##   gunicorn -c gunicorn.conf.py wsgi:app
+##
+## Every worker process imports the app itself (no preloading), so it owns its job pool,
+## caches and scheduler thread. Shared state lives in the SQLite store, which serializes
+## writers across processes; the Stan model is compiled by the first worker while the others
+## wait on a lock file, and only one worker runs the recommendation refreshes. All processes
+## draw sampler cores from one host-wide CPU budget (see backend/cpu_budget.py), and /metrics
+## exports the stage timings of all of them (see backend/metrics.py).
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.metrics import clear_metrics_dir
+
+bind = os.environ.get('TONEDOWN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('TONEDOWN_WEB_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Threads per worker; the analysis work itself runs in the job pools and the sampler budget
+worker_class = 'gthread'
+threads = int(os.environ.get('TONEDOWN_WEB_THREADS', '4'))
+# A synchronous hierarchical fit can take minutes
+timeout = int(os.environ.get('TONEDOWN_WEB_TIMEOUT', '300'))
+graceful_timeout = 30
+preload_app = False
+accesslog = '-'
+
+def on_starting(server):
+    # Start the stage histograms from zero; the files of the previous run are stale
+    clear_metrics_dir()
@@ -0,0 +1,105 @@
+## STREAMING INGESTION OF UPLOADED RECORDS
+## Parses CSV or NDJSON request bodies in fixed-size chunks with explicit dtypes for the known
+## columns and validates every chunk against the record schema, so bulk backfills can be written
+## to storage batch by batch without holding the whole payload in memory.
+
+import io
+import pandas as pd
+
+from flask_backend.storage import RECORD_COLUMNS
+
+# Rows parsed and written per batch
+CHUNK_ROWS = 5000
+
+# Explicit dtypes of the known columns; is_private stays a string and is normalized by storage
+RECORD_DTYPES = {
+    'uid': 'string',
+    'tinnitus-initial': 'float64',
+    'stress': 'float64',
+    'sleep': 'float64',
+    'noise': 'float64',
+    'intoxication': 'string',
+    'location': 'string',
+    'feedback': 'float64',
+    'is_private': 'string',
+    'timestamp': 'string',
+}
+REQUIRED_COLUMNS = ('uid', 'timestamp')
+
+CSV_CONTENT_TYPES = ('text/csv', 'application/csv')
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+class SchemaError(ValueError):
+    """
+    Raised when uploaded records do not match the record schema.
+    """
+
+def validate_batch(batch, first_row):
+    """
+    Check a parsed batch against the schema and coerce it to the record dtypes.
+
+    Parameters:
+      batch (pd.DataFrame): Parsed rows.
+      first_row (int): Index of the batch's first row in the upload, for error messages.
+
+    Returns:
+      pd.DataFrame: The batch with RECORD_DTYPES applied to the known columns.
+
+    Raises:
+      SchemaError: On unknown or missing columns, missing uids or non-numeric values.
+    """
+    unknown = [col for col in batch.columns if col not in RECORD_COLUMNS]
+    if unknown:
+        raise SchemaError(f"Unknown columns: {unknown}")
+    missing = [col for col in REQUIRED_COLUMNS if col not in batch.columns]
+    if missing:
+        raise SchemaError(f"Missing required columns: {missing}")
+
+    for col in batch.columns:
+        if RECORD_DTYPES[col] == 'float64':
+            values = pd.to_numeric(batch[col], errors='coerce')
+            bad = values.isna() & batch[col].notna() & (batch[col].astype('string').str.strip() != '')
+            if bad.any():
+                row = first_row + int(bad.to_numpy().nonzero()[0][0])
+                raise SchemaError(f"Non-numeric value {batch[col][bad].iloc[0]!r} in column '{col}' (row {row})")
+            batch[col] = values
+        else:
+            batch[col] = batch[col].astype(RECORD_DTYPES[col])
+
+    if batch['uid'].isna().any():
+        row = first_row + int(batch['uid'].isna().to_numpy().nonzero()[0][0])
+        raise SchemaError(f"Missing uid (row {row})")
+    return batch
+
+def iter_record_batches(stream, content_type='text/csv', chunk_rows=CHUNK_ROWS):
+    """
+    Parse a CSV or NDJSON byte or text stream into validated record batches.
+
+    Parameters:
+      stream: File-like object with the request body.
+      content_type (str): MIME type of the body (CSV or NDJSON).
+      chunk_rows (int): Rows per batch.
+
+    Yields:
+      pd.DataFrame: Validated batches of at most chunk_rows rows.
+
+    Raises:
+      SchemaError: If the content type is unsupported or a batch fails validation.
+    """
+    mime = (content_type or '').split(';')[0].strip().lower()
+    if mime in CSV_CONTENT_TYPES:
+        # Parse every column as text first; validate_batch applies the numeric dtypes so a
+        # bad value is reported with its column and row instead of as a parser error
+        reader = pd.read_csv(stream, chunksize=chunk_rows, dtype=str, keep_default_na=True)
+    elif mime in NDJSON_CONTENT_TYPES:
+        if not isinstance(stream, io.TextIOBase):
+            stream = io.TextIOWrapper(stream, encoding='utf-8')
+        reader = pd.read_json(stream, lines=True, chunksize=chunk_rows, dtype=False,
+                              convert_dates=False, keep_default_dates=False)
+    else:
+        raise SchemaError(f"Unsupported content type '{content_type}', expected CSV or NDJSON")
+
+    first_row = 0
+    for batch in reader:
+        yield validate_batch(batch, first_row)
+        first_row += len(batch)
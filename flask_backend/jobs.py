@@ -0,0 +1,205 @@
+## ANALYSIS JOBS
+## Runs analyses outside the request thread. Jobs are executed by a local process pool; the
+## HTTP layer submits a job, gets a job id back and polls (or long-polls) for the result.
+## Requests for the same user and the same data revision share a single in-flight job.
+
+import multiprocessing
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+from backend.backend_wrapper import (
+    backend_call, backend_call_batch, load_user_posterior_state, private_user_call,
+    GAUSSIANIZE_FEEDBACK
+)
+from backend.hierarchical_sampler import warm_up_model
+from flask_backend import storage
+
+# Number of worker processes running analyses
+JOB_WORKERS = int(os.environ.get('TONEDOWN_JOB_WORKERS', '2'))
+# Finished jobs are kept this long for polling
+JOB_TTL_SECONDS = 600
+# Workers are started from a clean server process, not forked from the threaded app process:
+# a fork while another thread holds a lock (dataset cache, model registry, metrics) deadlocks
+# the child
+JOB_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# MAIN ANALYSIS FUNCTION
+def run_analysis(db_path, user_id):
+    """
+    Compute the intervention ranking of a user from the data in the store.
+
+    Private users are served from their stored posterior state; everybody else goes
+    through backend_call on the merged data.
+
+    Parameters:
+      db_path (str): Path of the storage database.
+      user_id (str): The requesting user.
+
+    Returns:
+      dict: The user's formatted posterior probabilities of each intervention being the best.
+
+    Raises:
+      LookupError: If no data has been uploaded yet.
+    """
+    # Private users are served from their stored posterior state without reading the data
+    # (the state holds raw feedback scores, so not when feedback is gaussianized)
+    stored_state = None if GAUSSIANIZE_FEEDBACK else storage.load_state(db_path, user_id)
+    if stored_state is not None:
+        user_state = load_user_posterior_state(stored_state)
+        if user_state['is_private']:
+            _, diagnosis_probabilities = private_user_call(user_state)
+            return diagnosis_probabilities
+
+    # Read the merged regular and feedback data from the store
+    database_pull, revision, feedback_reference = storage.load_database_pull(
+        db_path, with_feedback_reference=True
+    )
+    if database_pull is None:
+        raise LookupError(f"No data found in {db_path}")
+    print(f"Found {len(database_pull)} total records in database")
+
+    # Run the backend analysis
+    _, diagnosis_probabilities = backend_call(user_id, database_pull, data_version=revision,
+                                              feedback_reference=feedback_reference)
+    return diagnosis_probabilities
+
+def run_batch_analysis(db_path, user_ids):
+    """
+    Compute the intervention rankings of many users with a single hierarchical fit.
+
+    Parameters:
+      db_path (str): Path of the storage database.
+      user_ids (list or str): The users to rank, or "all" for every shared user.
+
+    Returns:
+      tuple: (results, revision) - uid -> formatted probabilities, and the store revision
+             the rankings were computed from (a cached fit of an earlier revision is not
+             used, so all results belong to this revision).
+
+    Raises:
+      LookupError: If no data has been uploaded yet.
+    """
+    database_pull, revision, feedback_reference = storage.load_database_pull(
+        db_path, with_feedback_reference=True
+    )
+    if database_pull is None:
+        raise LookupError(f"No data found in {db_path}")
+    results = backend_call_batch(user_ids, database_pull, data_version=revision,
+                                 feedback_reference=feedback_reference, exact_revision=True)
+    return results, revision
+
+def _init_worker():
+    # Load the compiled model once per worker; the CPU budget is shared host-wide
+    warm_up_model()
+
+class AnalysisJobQueue:
+    """
+    Local job queue for analyses, backed by a process pool.
+
+    Jobs are keyed by (user_id, data revision): submitting an analysis while an identical
+    one is queued or running returns the existing job instead of starting a new one.
+    """
+
+    def __init__(self, db_path, max_workers=JOB_WORKERS, ttl_seconds=JOB_TTL_SECONDS):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        # Every worker process loads the compiled model once
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context(JOB_START_METHOD),
+            initializer=_init_worker
+        )
+        self._jobs = {}        # job_id -> job record
+        self._in_flight = {}   # (user_id, revision) -> job_id
+        self._lock = threading.Lock()
+
+    def submit(self, user_id):
+        """
+        Submit an analysis for a user, or join an identical in-flight one.
+
+        Returns:
+          str: The job id.
+        """
+        revision = storage.get_revision(self.db_path)
+        key = (user_id, revision)
+        with self._lock:
+            self._prune()
+            job_id = self._in_flight.get(key)
+            if job_id is not None:
+                return job_id
+
+            job_id = uuid.uuid4().hex
+            future = self._executor.submit(run_analysis, self.db_path, user_id)
+            self._jobs[job_id] = {
+                'user_id': user_id,
+                'revision': revision,
+                'submitted_at': time.time(),
+                'finished_at': None,
+                'future': future,
+            }
+            self._in_flight[key] = job_id
+        future.add_done_callback(lambda _: self._finish(job_id, key))
+        return job_id
+
+    def status(self, job_id, wait=0):
+        """
+        Return the state of a job, optionally waiting up to `wait` seconds for it to finish.
+
+        Returns:
+          dict or None: The job status ('queued', 'running', 'done' or 'failed') with the
+                        result or error, or None if the job id is unknown or expired.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+
+        future = job['future']
+        if wait > 0:
+            try:
+                future.result(timeout=wait)
+            except FutureTimeoutError:
+                pass
+            except Exception:
+                # Reported below as a failed job
+                pass
+
+        status = {
+            'job_id': job_id,
+            'user_id': job['user_id'],
+            'revision': job['revision'],
+        }
+        if not future.done():
+            status['status'] = 'running' if future.running() else 'queued'
+        elif future.exception() is not None:
+            status['status'] = 'failed'
+            status['error'] = str(future.exception())
+        else:
+            status['status'] = 'done'
+            status['result'] = future.result()
+        return status
+
+    def shutdown(self):
+        """
+        Stop the worker pool, waiting for running jobs.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _finish(self, job_id, key):
+        with self._lock:
+            if self._in_flight.get(key) == job_id:
+                del self._in_flight[key]
+            if job_id in self._jobs:
+                self._jobs[job_id]['finished_at'] = time.time()
+
+    def _prune(self):
+        # Forget finished jobs once their results have expired (called with the lock held)
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished_at'] is not None and now - job['finished_at'] > self.ttl_seconds
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
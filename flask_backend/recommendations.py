@@ -0,0 +1,117 @@
+## PRECOMPUTED RECOMMENDATIONS
+## A background thread recomputes every user's intervention ranking with one batch analysis
+## when new feedback arrives or on a fixed interval, and stores the rankings in the
+## recommendations table. /api/get-analysis then serves a stored snapshot with a lookup.
+## Under a multi-worker server every worker starts a scheduler, but only the one holding the
+## scheduler lock file refreshes; the others stand by and take over if it exits.
+
+import os
+import threading
+import time
+
+from backend.backend_wrapper import backend_call_batch
+from backend.file_lock import file_lock
+from flask_backend import storage
+
+# Seconds between checks for new data (uploads received by other workers are only seen here)
+REFRESH_INTERVAL_SECONDS = float(os.environ.get('TONEDOWN_REFRESH_INTERVAL', '60'))
+# Seconds to wait after a notification, so a burst of uploads triggers a single refresh
+REFRESH_DEBOUNCE_SECONDS = float(os.environ.get('TONEDOWN_REFRESH_DEBOUNCE', '5'))
+
+def refresh_recommendations(db_path):
+    """
+    Recompute and store the rankings of all users from the current data.
+
+    Returns:
+      int or None: The store revision the rankings were computed from, or None without data
+                   or if the fit failed (nothing is stored then, and the next check retries).
+    """
+    database_pull, revision, feedback_reference = storage.load_database_pull(
+        db_path, with_feedback_reference=True
+    )
+    if database_pull is None:
+        return None
+    user_ids = list(database_pull['uid'].unique())
+    # The rankings are stored under this revision, so they must come from a fit of it
+    diagnostics = {}
+    rankings = backend_call_batch(user_ids, database_pull, data_version=revision,
+                                  feedback_reference=feedback_reference, exact_revision=True,
+                                  diagnostics=diagnostics)
+    if 'error' in diagnostics:
+        # Do not replace the stored rankings with the uniform fallback
+        print(f"Not storing recommendations of revision {revision}: {diagnostics['error']}")
+        return None
+    storage.save_recommendations(db_path, rankings, revision)
+    print(f"Refreshed recommendations of {len(rankings)} users at revision {revision}")
+    return revision
+
+class RecommendationScheduler:
+    """
+    Background thread refreshing the stored recommendations.
+
+    A refresh runs when notify() was called (after a debounce delay) or when the refresh
+    interval has passed, and only if the store revision changed since the last refresh.
+    Of all schedulers of a store, only the one holding its lock file refreshes.
+    """
+
+    def __init__(self, db_path, interval=REFRESH_INTERVAL_SECONDS, debounce=REFRESH_DEBOUNCE_SECONDS):
+        self.db_path = db_path
+        self.interval = interval
+        self.debounce = debounce
+        self.last_revision = None
+        self.last_refresh = None
+        self.is_leader = False
+        self.lock_path = db_path + '.scheduler-lock'
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the scheduler thread (once); the first refresh runs right away.
+        """
+        if self._thread is None:
+            self._wake.set()
+            self._thread = threading.Thread(target=self._run, name='recommendation-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the scheduler thread after the current refresh.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def notify(self):
+        """
+        Request a refresh soon, e.g. after new feedback was uploaded.
+        """
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with file_lock(self.lock_path, blocking=False) as leader:
+                self.is_leader = leader
+                if leader:
+                    self._refresh_loop()
+            self.is_leader = False
+            # Standby: try to take over the lock later
+            self._stop.wait(self.interval)
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            if self._wake.wait(timeout=self.interval):
+                # Let a burst of uploads settle before refreshing
+                self._stop.wait(self.debounce)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                if storage.get_revision(self.db_path) != self.last_revision:
+                    self.last_revision = refresh_recommendations(self.db_path)
+                    self.last_refresh = time.time()
+            except Exception as e:
+                print(f"Error refreshing recommendations: {str(e)}")
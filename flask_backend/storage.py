@@ -0,0 +1,485 @@
+## APPEND-ONLY STORAGE FOR UPLOADED TINNITUS DATA
+## Records are kept in a single SQLite database (WAL mode) with an index on (uid, timestamp),
+## so an upload is an append whose cost does not depend on the size of the history, and
+## concurrent writers are serialized by SQLite's own file locking.
+
+import os
+import json
+import sqlite3
+import threading
+import time
+import pandas as pd
+
+from backend.file_lock import file_lock
+from backend.metrics import span
+from backend.reference_index import ReferenceIndex
+
+# Known record columns, in the order the ToneDown app sends them
+RECORD_COLUMNS = ['uid', 'tinnitus-initial', 'stress', 'sleep', 'noise', 'intoxication',
+                  'location', 'feedback', 'is_private', 'timestamp']
+
+# Source tags for the two upload streams
+SOURCE_REGULAR = 'regular'
+SOURCE_FEEDBACK = 'feedback'
+
+# Legacy CSV files that are imported into the database the first time it is created
+LEGACY_FILES = {
+    SOURCE_REGULAR: 'tinnitus_data.csv',
+    SOURCE_FEEDBACK: 'tinnitus_data_feedback.csv',
+}
+
+DB_FILENAME = 'tinnitus_data.db'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    "tinnitus-initial",
+    stress,
+    sleep,
+    noise,
+    intoxication,
+    location,
+    feedback,
+    is_private INTEGER,
+    timestamp TEXT
+);
+CREATE INDEX IF NOT EXISTS records_uid_timestamp ON records (uid, timestamp);
+CREATE TABLE IF NOT EXISTS posterior_state (
+    uid TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    revision INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS recommendations (
+    uid TEXT PRIMARY KEY,
+    ranking TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    computed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+'''
+
+# AUXILIARY FUNCTIONS
+def _count_key(source):
+    # meta key of the record counter of a source, kept up to date by append_records
+    return f'record_count:{source}'
+
+def _connect(db_path):
+    """
+    Open a connection to the store. Connections are cheap and opened per call, so the
+    store can be used from any thread or worker process.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def _to_private_flag(value):
+    """
+    Convert an is_private value (bool, 'true'/'false' string, number or NaN) to 1, 0 or None.
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value == '':
+            return None
+        return int(value in ('true', '1', 'yes'))
+    return int(bool(value))
+
+def _to_sql_value(value):
+    """
+    Convert a pandas cell to a value SQLite can store (NaN becomes NULL).
+    """
+    if value is None:
+        return None
+    if not isinstance(value, str) and pd.isna(value):
+        return None
+    if hasattr(value, 'item'):
+        # numpy scalar
+        return value.item()
+    return value
+
+def _records_from_frame(df, source):
+    """
+    Convert a DataFrame of uploaded rows to tuples for insertion. Unknown columns are dropped
+    and missing known columns are stored as NULL.
+    """
+    rows = []
+    columns = [col for col in RECORD_COLUMNS if col in df.columns]
+    for values in df[columns].itertuples(index=False, name=None):
+        record = dict(zip(columns, values))
+        rows.append(tuple(
+            [source, str(record.get('uid', 'unknown'))]
+            + [_to_sql_value(record.get(col)) for col in RECORD_COLUMNS[1:-2]]
+            + [_to_private_flag(record.get('is_private')),
+               _to_sql_value(record.get('timestamp'))]
+        ))
+    return rows
+
+# MAIN ENTRY POINTS
+def init_store(upload_dir):
+    """
+    Create the database (and import legacy CSV files on first use).
+
+    Parameters:
+      upload_dir (str): Directory holding the database and any legacy CSV files.
+
+    Returns:
+      str: Path of the database file.
+    """
+    os.makedirs(upload_dir, exist_ok=True)
+    db_path = os.path.join(upload_dir, DB_FILENAME)
+    # Every worker of a multi-worker server calls this at startup; only one may import
+    with file_lock(db_path + '.init-lock'):
+        conn = _connect(db_path)
+        try:
+            with conn:
+                conn.executescript(_SCHEMA)
+                # Stores created before the record counters count their records once
+                for source in LEGACY_FILES:
+                    conn.execute(
+                        'INSERT OR IGNORE INTO meta (key, value) '
+                        'SELECT ?, COUNT(*) FROM records WHERE source = ? '
+                        'AND NOT EXISTS (SELECT 1 FROM meta WHERE key = ?)',
+                        (_count_key(source), source, _count_key(source))
+                    )
+            is_empty = conn.execute('SELECT 1 FROM records LIMIT 1').fetchone() is None
+        finally:
+            conn.close()
+
+        if is_empty:
+            for source, filename in LEGACY_FILES.items():
+                legacy_path = os.path.join(upload_dir, filename)
+                if os.path.exists(legacy_path):
+                    legacy_df = pd.read_csv(legacy_path)
+                    append_records(db_path, legacy_df, source)
+                    print(f"Imported {len(legacy_df)} records from {legacy_path}")
+    return db_path
+
+def append_records(db_path, df, source, state_update=None):
+    """
+    Append uploaded rows to the store in a single transaction.
+
+    Parameters:
+      db_path (str): Path of the database file.
+      df (pd.DataFrame): New rows, with (a subset of) RECORD_COLUMNS.
+      source (str): SOURCE_REGULAR or SOURCE_FEEDBACK.
+      state_update (callable): Optional function (state, rows) -> state that maintains a
+                               per-user state string in the same transaction. It receives
+                               the stored state and the user's new rows, or None and the
+                               user's full history if no state is stored yet.
+
+    Returns:
+      tuple: (revision, record_count) - the store revision after the append and the total
+             number of records for this source.
+    """
+    rows = _records_from_frame(df, source)
+    placeholders = ', '.join(['?'] * (len(RECORD_COLUMNS) + 1))
+    quoted_columns = ', '.join(f'"{col}"' for col in RECORD_COLUMNS)
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.executemany(
+                f'INSERT INTO records (source, {quoted_columns}) VALUES ({placeholders})', rows
+            )
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+            revision = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+            # A counter instead of COUNT(*), which scans all records of the source
+            conn.execute(
+                'INSERT INTO meta (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = value + excluded.value',
+                (_count_key(source), len(rows))
+            )
+            record_count = conn.execute(
+                'SELECT value FROM meta WHERE key = ?', (_count_key(source),)
+            ).fetchone()[0]
+            if state_update is not None:
+                with span('state_update'):
+                    _update_states(conn, rows, revision, state_update)
+    finally:
+        conn.close()
+    return revision, record_count
+
+def _update_states(conn, rows, revision, state_update):
+    """
+    Apply state_update to every user in the inserted rows, inside the append transaction.
+    """
+    new_df = pd.DataFrame(rows, columns=['source'] + RECORD_COLUMNS)
+    quoted_columns = ', '.join(f'"{col}"' for col in RECORD_COLUMNS)
+    for uid, user_rows in new_df.groupby('uid', sort=False):
+        stored = conn.execute('SELECT state FROM posterior_state WHERE uid = ?', (uid,)).fetchone()
+        if stored is None:
+            # No state yet: build it from the user's full history (served from the index)
+            history = pd.read_sql_query(
+                f'SELECT {quoted_columns} FROM records WHERE uid = ? ORDER BY timestamp, id',
+                conn, params=(uid,)
+            )
+            state = state_update(None, history)
+        else:
+            state = state_update(stored[0], user_rows[RECORD_COLUMNS])
+        conn.execute(
+            'INSERT OR REPLACE INTO posterior_state (uid, state, revision) VALUES (?, ?, ?)',
+            (uid, state, revision)
+        )
+
+def load_state(db_path, uid):
+    """
+    Return the stored per-user state string, or None if the user has none.
+    """
+    conn = _connect(db_path)
+    try:
+        stored = conn.execute('SELECT state FROM posterior_state WHERE uid = ?', (uid,)).fetchone()
+    finally:
+        conn.close()
+    return None if stored is None else stored[0]
+
+def save_recommendations(db_path, rankings, revision):
+    """
+    Store precomputed rankings, replacing older ones of the same users.
+
+    Parameters:
+      db_path (str): Path of the database file.
+      rankings (dict): uid -> formatted ranking (JSON-serializable).
+      revision (int): Store revision the rankings were computed from.
+    """
+    computed_at = time.time()
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO recommendations (uid, ranking, revision, computed_at) '
+                'VALUES (?, ?, ?, ?)',
+                [(uid, json.dumps(ranking), revision, computed_at) for uid, ranking in rankings.items()]
+            )
+    finally:
+        conn.close()
+
+def load_recommendation(db_path, uid):
+    """
+    Return the latest precomputed ranking of a user.
+
+    Returns:
+      tuple or None: (ranking, revision, computed_at), or None if there is none.
+    """
+    conn = _connect(db_path)
+    try:
+        row = conn.execute(
+            'SELECT ranking, revision, computed_at FROM recommendations WHERE uid = ?', (uid,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return json.loads(row[0]), row[1], row[2]
+
+def get_recommendations_revision(db_path):
+    """
+    Return the newest revision the stored recommendations were computed at, or None.
+    """
+    conn = _connect(db_path)
+    try:
+        return conn.execute('SELECT MAX(revision) FROM recommendations').fetchone()[0]
+    finally:
+        conn.close()
+
+def get_record_count(db_path, source):
+    """
+    Return the number of stored records of a source.
+    """
+    conn = _connect(db_path)
+    try:
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (_count_key(source),)).fetchone()
+        return row[0] if row is not None else 0
+    finally:
+        conn.close()
+
+def get_revision(db_path):
+    """
+    Return the store revision, which is incremented by every append.
+    """
+    conn = _connect(db_path)
+    try:
+        return conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+    finally:
+        conn.close()
+
+def load_records(db_path, uid=None, source=None, with_revision=False, after_id=None):
+    """
+    Load records from the store, ordered by timestamp.
+
+    Parameters:
+      db_path (str): Path of the database file.
+      uid (str): If given, only this user's records are loaded (served from the index).
+      source (str): If given, only records from this source are loaded.
+      with_revision (bool): If True, also return the revision the records were read at.
+      after_id (int): If given, only records appended after the record with this id are
+                      loaded, and the record ids are returned in an 'id' column.
+
+    Returns:
+      pd.DataFrame: The records with RECORD_COLUMNS; is_private is a nullable value.
+                    With with_revision, a tuple (records, revision).
+    """
+    quoted_columns = ', '.join(f'"{col}"' for col in RECORD_COLUMNS)
+    clauses, params = [], []
+    if after_id is not None:
+        quoted_columns = 'id, ' + quoted_columns
+        clauses.append('id > ?')
+        params.append(after_id)
+    if uid is not None:
+        clauses.append('uid = ?')
+        params.append(uid)
+    if source is not None:
+        clauses.append('source = ?')
+        params.append(source)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    conn = _connect(db_path)
+    try:
+        # Read the records and the revision from the same snapshot
+        conn.execute('BEGIN')
+        df = pd.read_sql_query(
+            f'SELECT {quoted_columns} FROM records {where} ORDER BY timestamp, id', conn,
+            params=params
+        )
+        revision = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    if with_revision:
+        return df, revision
+    return df
+
+class MergedDatasetCache:
+    """
+    In-memory copy of the merged records of a store, shared by all threads of a process.
+
+    Every read checks the store revision (a single-row query). When another upload - from this
+    or any other process - has bumped it, only the records appended since the last read are
+    fetched and merged into the cached frame, so reads stop paying the full load and parse.
+    The returned frame is shared and must be treated as read-only. The cache also maintains
+    a ReferenceIndex of all feedback scores, extended with the new records on every refresh.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._data = None
+        self._revision = None
+        self._last_id = 0
+        self._feedback_reference = ReferenceIndex()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return (database_pull, revision) as documented in load_database_pull.
+        """
+        return self.snapshot()[:2]
+
+    def snapshot(self):
+        """
+        Return (database_pull, revision, feedback_reference), all read at the same revision.
+        """
+        with self._lock:
+            if self._revision is not None and get_revision(self.db_path) == self._revision:
+                return self._frame(), self._revision, self._feedback_reference
+
+            with span('data_load'):
+                new_records, revision = load_records(
+                    self.db_path, with_revision=True, after_id=self._last_id
+                )
+            with span('merge'):
+                if not new_records.empty:
+                    last_id = int(new_records['id'].max())
+                    new_records = new_records.drop(columns='id')
+                    # Nullable boolean: a missing is_private keeps the user's earlier setting,
+                    # as in extract_all_user_data and update_user_posterior_state
+                    new_records['is_private'] = new_records['is_private'].astype('boolean')
+                    # A new index object, so references handed out earlier stay unchanged
+                    feedback_reference = self._feedback_reference.merged(
+                        pd.to_numeric(new_records['feedback'], errors='coerce').to_numpy(dtype=float)
+                    )
+                    if self._data is None or self._data.empty:
+                        data = new_records.reset_index(drop=True)
+                    else:
+                        # Records without a timestamp are stored too; compare only known values
+                        # and fall back to a full sort whenever one is missing
+                        new_timestamps = new_records['timestamp'].dropna()
+                        cached_timestamps = self._data['timestamp'].dropna()
+                        needs_sort = (
+                            len(new_timestamps) < len(new_records)
+                            or len(cached_timestamps) < len(self._data)
+                            or (not cached_timestamps.empty
+                                and new_timestamps.min() < cached_timestamps.max())
+                        )
+                        data = pd.concat([self._data, new_records], ignore_index=True)
+                        if needs_sort:
+                            # Late records: restore the timestamp order
+                            data = data.sort_values(
+                                'timestamp', kind='stable', ignore_index=True
+                            )
+                    # Only advance past the new records once they are merged
+                    self._data = data
+                    self._last_id = last_id
+                    self._feedback_reference = feedback_reference
+                elif self._data is None:
+                    self._data = new_records.drop(columns='id')
+            self._revision = revision
+            return self._frame(), self._revision, self._feedback_reference
+
+    @property
+    def revision(self):
+        """
+        Store revision of the cached records, None before the first read.
+        """
+        return self._revision
+
+    def clear(self):
+        """
+        Drop the cached records; the next read reloads everything.
+        """
+        with self._lock:
+            self._data = None
+            self._revision = None
+            self._last_id = 0
+            self._feedback_reference = ReferenceIndex()
+
+    def _frame(self):
+        return None if self._data is None or self._data.empty else self._data
+
+_DATASET_CACHES = {}
+_DATASET_CACHES_LOCK = threading.Lock()
+
+def get_dataset_cache(db_path):
+    """
+    Return the process-wide MergedDatasetCache of a store.
+    """
+    with _DATASET_CACHES_LOCK:
+        cache = _DATASET_CACHES.get(db_path)
+        if cache is None:
+            cache = MergedDatasetCache(db_path)
+            _DATASET_CACHES[db_path] = cache
+        return cache
+
+def load_database_pull(db_path, with_feedback_reference=False):
+    """
+    Load the merged regular and feedback records in the format expected by backend_call.
+
+    Reads go through the process-wide MergedDatasetCache, so only records appended since the
+    previous read are fetched from the store.
+
+    Parameters:
+      db_path (str): Path of the database file.
+      with_feedback_reference (bool): Also return the ReferenceIndex of all feedback scores.
+
+    Returns:
+      tuple: (database_pull, revision) - all records sorted by timestamp with a nullable
+             boolean is_private column (None if nothing has been uploaded yet), and the store
+             revision they were read at. The frame is shared and must not be modified.
+             With with_feedback_reference, the reference index is appended to the tuple.
+    """
+    snapshot = get_dataset_cache(db_path).snapshot()
+    return snapshot if with_feedback_reference else snapshot[:2]
@@ -0,0 +1,12 @@
+## WSGI ENTRY POINT
+## Production servers load the app from here, e.g. from the flask_backend directory:
+##   gunicorn -c gunicorn.conf.py wsgi:app
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_backend.app import create_app
+
+app = application = create_app()